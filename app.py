@@ -8,6 +8,7 @@ import time
 import shutil
 
 from experiment_manager import ExperimentSystemManager
+from artifact_store import ArtifactStore
 
 # first create the flask app to avoid reloading the ExperimentSystemManager
 app = Flask(__name__)
@@ -23,10 +24,10 @@ except Exception as e:
     exit(1)
 # manually set the datapath for now TODO: make this updateable from the web interface
 esm.datapath = "/home/sunlab/beamscan_data"
-time.sleep(5) # wait for the GNU Radio process to start
-if esm.gnu_service.poll() is not None: # make sure the GNU Radio process is running
+if not esm.gnu_service.wait_ready(timeout=30): # returns as soon as the GNU Radio process is up
     print("GNU Radio process is not running, exiting.")
     esm.shutdown()
+    exit(1)
 
 #check if the directory exists
 if not os.path.exists(esm.datapath):
@@ -35,12 +36,14 @@ if not os.path.exists(esm.datapath):
     print(f"Created directory {esm.datapath}")
 else:
     print(f"Experiment Data Directory Found: {esm.datapath}")
+esm.store = ArtifactStore(esm.datapath) # each scan is committed at once to {datapath}/scans/<scan_id>/
 
 
 def get_newest_image(suffix:str=".png",directory:str="") -> str:
     '''walk through the directory and find the newest image file with the given suffix'''
     image_path = None
     for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')] # skip the staging directories of unfinished scans
         for file in files:
             if file.endswith(suffix):
                 if image_path is None:
@@ -71,23 +74,24 @@ def index():
     image_path_camera = get_newest_image(suffix="_camera.jpg" , directory=esm.datapath)
     print(f'{image_path_mse=}'); print(f'{image_path_mean=}'); print(f'{image_path_camera=}')
     # if found, copy and overwrite the images to the static directory
+    # (copyfile, not copy: the store objects are read-only and copy would make the static files read-only too)
     if image_path_mean is not None:
         base_timestamp = os.path.basename(image_path_mean).split('_')[0] # this is the timestamp
         destination_path_mean = 'static/gp_heatmap.png'
-        shutil.copy(image_path_mean, destination_path_mean)
+        shutil.copyfile(image_path_mean, destination_path_mean)
     else:
         base_timestamp = 'No Scan Data'
         destination_path_mean = 'static/no_scan_placeholder.png'
 
     if image_path_mse is not None:
         destination_path_mse = 'static/gp_heatmap_std.png'
-        shutil.copy(image_path_mse, destination_path_mse)
+        shutil.copyfile(image_path_mse, destination_path_mse)
     else:
         destination_path_mse = 'static/no_scan_placeholder.png'
 
     if image_path_camera is not None:
         destination_path_camera = 'static/camera.jpg'
-        shutil.copy(image_path_camera, destination_path_camera)
+        shutil.copyfile(image_path_camera, destination_path_camera)
     else:
         destination_path_camera = 'static/no_scan_placeholder.png'
     
@@ -110,8 +114,10 @@ def beamscan():
     print("Beamscan data saved.", end=" ")
     esm.save_camera_image()
     print("Camera image saved.", end=" ")
+    esm.save_preview() # interpolated heatmap, available before the GP is fitted
     print("Beamscan process finished. Fitting Gaussian Process model.")
     esm.vis_gp_heatmap()
+    esm.commit_scan() # the index page shows the newest images, publish the complete scan first
     print("Gaussian Process model fitted and saved.")
     # flash(f"Beamscan process completed.\n Saved data with base_filename {esm.base_filename}")
     return redirect(url_for('index'))
@@ -0,0 +1,170 @@
+# this is a content-addressed store for the artifacts of each scan (csi data, camera image, heatmaps, html, model)
+# every file is stored once under objects/<sha256[:2]>/<sha256[2:]>, identical artifacts (placeholder images,
+# the shared plotly.js bundle, repeated heatmaps) take the disk space of a single copy
+
+# a scan is written into its own staging directory and committed at once:
+#   the files are hashed and moved (or deduplicated) into the objects,
+#   the scan view scans/<scan_id>/ (hardlinks to the objects, same filenames as before) and its manifest.json
+#   are built in a temporary directory and renamed into place, so a scan is either complete or absent
+# scan ids carry microseconds and a random suffix, two scans (or two writers) never collide
+
+# usage:
+#   store = ArtifactStore('/home/sunlab/beamscan_data')
+#   staging = store.begin_scan()
+#   ... write files into staging.path (ex. f"{staging.base}_camera.jpg") ...
+#   manifest = store.commit_scan(staging)
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+import uuid
+from dataclasses import dataclass
+
+from artifact_writer import write_atomic
+
+MANIFEST_FILENAME = "manifest.json"
+
+def new_scan_id() -> str:
+    '''a unique, time sortable scan id: YYYYmmdd-HHMMSS-microseconds-random (ex. 20250101-120000-123456-3f9a2c)
+    it starts with the old time.strftime("%Y%m%d-%H%M%S") base filename, so the existing tools still parse it'''
+    now = time.time()
+    return f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now % 1 * 1e6):06d}-{uuid.uuid4().hex[:6]}"
+
+def file_sha256(filename:str) -> str:
+    '''sha256 hex digest of a file's content'''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class ScanStaging:
+    '''the staging directory of a scan that is being written'''
+    scan_id:str
+    path:str # write the artifacts of the scan into this directory
+
+    @property
+    def base(self) -> str:
+        '''the base filename of the artifacts, ex. f"{staging.base}_camera.jpg"'''
+        return os.path.join(self.path, self.scan_id)
+
+
+class ArtifactStore:
+    '''Content-addressed, deduplicating store of scan artifacts with one manifest per scan'''
+    def __init__(self, root:str):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.scans_dir = os.path.join(root, "scans")
+        self.staging_dir = os.path.join(root, ".staging") # hidden, the newest-image lookup of the app skips it
+        for directory in (self.objects_dir, self.scans_dir, self.staging_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def object_path(self, digest:str) -> str:
+        '''the path of the object with the given sha256'''
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def begin_scan(self, scan_id:str|None=None) -> ScanStaging:
+        '''create the staging directory of a new scan'''
+        scan_id = new_scan_id() if scan_id is None else scan_id
+        path = os.path.join(self.staging_dir, scan_id)
+        os.makedirs(path) # fails if the scan id is already being written
+        return ScanStaging(scan_id=scan_id, path=path)
+
+    def put(self, filename:str) -> tuple[str, bool]:
+        '''move a file into the objects, returns (sha256, True if it was already stored)
+        the file is removed, the objects are read only (they are shared by the hardlinked scan views)'''
+        digest = file_sha256(filename)
+        object_path = self.object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.chmod(filename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        try:
+            os.link(filename, object_path) # atomic, a concurrent writer of the same content gets FileExistsError
+            stored = False
+        except FileExistsError:
+            stored = True
+        except OSError: # no hardlinks on this filesystem
+            if os.path.exists(object_path):
+                stored = True
+            else:
+                os.replace(filename, object_path)
+                return digest, False
+        os.unlink(filename)
+        return digest, stored
+
+    def _link(self, object_path:str, filename:str):
+        '''hardlink an object into a scan view (copy if the filesystem has no hardlinks)'''
+        try:
+            os.link(object_path, filename)
+        except OSError:
+            shutil.copyfile(object_path, filename)
+
+    def commit_scan(self, staging:ScanStaging, meta:dict|None=None) -> dict:
+        '''store the files of the staging directory and publish the scan view scans/<scan_id>/
+        returns the manifest {'scan_id', 'committed', 'files': {name: {'sha256', 'size'}}, 'meta', 'stored_bytes'}'''
+        files = {}; stored_bytes = 0
+        for name in sorted(os.listdir(staging.path)):
+            filename = os.path.join(staging.path, name)
+            if not os.path.isfile(filename) or name.endswith(".tmp"): # skip unfinished atomic writes
+                continue
+            size = os.path.getsize(filename)
+            digest, duplicate = self.put(filename)
+            files[name] = {'sha256': digest, 'size': size}
+            if not duplicate:
+                stored_bytes += size
+        manifest = {'scan_id': staging.scan_id, 'committed': time.strftime("%Y%m%d-%H%M%S"),
+                    'files': files, 'meta': {} if meta is None else meta, 'stored_bytes': stored_bytes}
+
+        # build the view next to the final location and rename it, readers never see a partial scan
+        view_tmp = f"{staging.path}.view"
+        os.makedirs(view_tmp)
+        for name, entry in files.items():
+            self._link(self.object_path(entry['sha256']), os.path.join(view_tmp, name))
+        write_atomic(os.path.join(view_tmp, MANIFEST_FILENAME), json.dumps(manifest, indent=2).encode('utf-8'))
+        os.rename(view_tmp, self.scan_path(staging.scan_id))
+        shutil.rmtree(staging.path, ignore_errors=True)
+        total = sum(entry['size'] for entry in files.values())
+        print(f"Scan {staging.scan_id} committed: {len(files)} files, {total / 1e6:.2f} MB "
+              f"({stored_bytes / 1e6:.2f} MB new)")
+        return manifest
+
+    def abort_scan(self, staging:ScanStaging):
+        '''discard a scan that is being written'''
+        shutil.rmtree(staging.path, ignore_errors=True)
+
+    def scan_path(self, scan_id:str) -> str:
+        '''the directory of a committed scan'''
+        return os.path.join(self.scans_dir, scan_id)
+
+    def scan_ids(self) -> list[str]:
+        '''the sorted ids of the committed scans'''
+        return sorted(name for name in os.listdir(self.scans_dir)
+                      if os.path.exists(os.path.join(self.scans_dir, name, MANIFEST_FILENAME)))
+
+    def load_manifest(self, scan_id:str) -> dict:
+        '''the manifest of a committed scan'''
+        with open(os.path.join(self.scan_path(scan_id), MANIFEST_FILENAME)) as file:
+            return json.load(file)
+
+    def collect_garbage(self) -> int:
+        '''remove the objects no scan view links to anymore (ex. after deleting scans/<scan_id>),
+        returns the number of bytes freed, do not run it while a scan is being committed'''
+        referenced = None
+        freed = 0
+        for root, dirs, files in os.walk(self.objects_dir):
+            for name in files:
+                object_path = os.path.join(root, name)
+                info = os.stat(object_path)
+                if info.st_nlink > 1:
+                    continue
+                if referenced is None: # the link count is 1 for copies as well, check the manifests
+                    referenced = {entry['sha256'] for scan_id in self.scan_ids()
+                                  for entry in self.load_manifest(scan_id)['files'].values()}
+                if os.path.basename(root) + name not in referenced:
+                    os.unlink(object_path)
+                    freed += info.st_size
+        return freed
@@ -0,0 +1,118 @@
+# this is an asynchronous writer for the image artifacts of each scan (camera pictures, heatmap pngs)
+# raw arrays are handed over, encoded (jpeg/png) and written atomically on a small bounded thread pool
+# so the scan loop does not wait on the encoder or the disk
+
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+# the process umask, read once at import (os.umask can only be read by setting it, not thread safe later)
+_UMASK = os.umask(0); os.umask(_UMASK)
+
+def encode_image(image:np.ndarray, filename:str, rgb:bool=False,
+                 jpeg_quality:int=95, png_compression:int=3) -> bytes:
+    '''encode an image array to the format given by the filename extension (.jpg/.jpeg or .png)
+    image: HxW, HxWx3 or HxWx4 uint8 array, BGR(A) channel order like opencv unless rgb=True
+    jpeg_quality: 0-100, png_compression: 0-9 (higher is smaller and slower)'''
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.jpg', '.jpeg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+    elif ext == '.png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+    else:
+        raise ValueError(f"Unsupported image extension: {ext}, expected .jpg, .jpeg or .png")
+    if rgb and image.ndim == 3: # opencv expects BGR(A)
+        image = image[..., [2, 1, 0, 3][:image.shape[2]]]
+    ok, buffer = cv2.imencode(ext, image, params)
+    if not ok:
+        raise RuntimeError(f"Failed to encode image for {filename}")
+    return buffer.tobytes()
+
+def write_atomic(filename:str, data:bytes):
+    '''write the bytes to a temporary file in the same directory and rename it over the filename
+    readers (ex. the flask app looking for the newest image) never see a partial file
+    the file gets the default permissions (0666 & ~umask) like open(), not the 0600 of mkstemp'''
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.chmod(tmp_filename, 0o666 & ~_UMASK)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+def write_image(image:np.ndarray, filename:str, rgb:bool=False,
+                jpeg_quality:int=95, png_compression:int=3) -> str:
+    '''encode and atomically write an image array, returns the filename'''
+    write_atomic(filename, encode_image(image, filename, rgb=rgb,
+                                        jpeg_quality=jpeg_quality, png_compression=png_compression))
+    return filename
+
+
+class ArtifactWriter:
+    '''Encodes and writes image arrays on a bounded thread pool, each submit returns a Future
+    at most max_pending images are queued, submit blocks when the queue is full (backpressure)'''
+    def __init__(self, max_workers:int=2, max_pending:int=8,
+                 jpeg_quality:int=95, png_compression:int=3):
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="artifact_writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending:dict[Future, str] = {} # queued or running writes -> filename
+        self._failed:dict[Future, str] = {} # writes that raised since the last wait
+        self._lock = threading.Lock()
+        self.failed:list[str] = [] # the filenames of the failed writes reported by the last wait
+
+    def submit_image(self, image:np.ndarray, filename:str, rgb:bool=False,
+                     jpeg_quality:int|None=None, png_compression:int|None=None) -> Future:
+        '''queue an image array to be encoded and written to filename
+        the array must not be modified after it is submitted
+        returns a Future resolving to the filename'''
+        jpeg_quality = self.jpeg_quality if jpeg_quality is None else jpeg_quality
+        png_compression = self.png_compression if png_compression is None else png_compression
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(write_image, image, filename, rgb, jpeg_quality, png_compression)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[future] = filename
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future:Future):
+        with self._lock:
+            filename = self._pending.pop(future, None)
+            if future.exception() is not None:
+                self._failed[future] = filename
+        self._slots.release()
+        if future.exception() is not None:
+            print(f"Failed to write artifact {filename}: {future.exception()}")
+        else:
+            print(f"artifact saved to {future.result()}")
+
+    def wait(self, timeout:float|None=None) -> bool:
+        '''wait for all the queued writes, returns True if they all completed and no write failed since
+        the last wait (the failed filenames are printed and kept in self.failed until the next wait)'''
+        with self._lock:
+            pending = dict(self._pending)
+        done, not_done = wait(list(pending), timeout=timeout)
+        with self._lock:
+            failed = dict(self._failed); self._failed.clear()
+        # a write can finish before its done callback has recorded it
+        failed.update({future: pending[future] for future in done if future.exception() is not None})
+        self.failed = sorted(str(filename) for filename in failed.values())
+        if self.failed:
+            print(f"Failed to write {len(self.failed)} artifacts: {self.failed}")
+        return len(not_done) == 0 and not self.failed
+
+    def shutdown(self):
+        '''finish the queued writes and stop the worker threads'''
+        self.executor.shutdown(wait=True)
@@ -2,38 +2,74 @@
 
 # taking a picture from cold start takes about 2.6 seconds!
 
+# the Camera class keeps a grabber thread reading the webcam so the newest frame is always buffered,
+# taking a picture is then just a copy of that frame (no cold start or buffer flushing per picture)
+
 import cv2
+import threading
 import time
 
+from artifact_writer import ArtifactWriter, write_image
+
 class Camera:
-    def __init__(self):
-        self.cap = cv2.VideoCapture(0)
-        self.resolution = (1920, 1080)
+    def __init__(self, device:int=0, resolution:tuple=(1920, 1080)):
+        self.cap = cv2.VideoCapture(device)
+        self.resolution = resolution
         self.cap.set(3, self.resolution[0])
         self.cap.set(4, self.resolution[1])
-        self.first_frame = True
-    
-    def take_picture(self, filename):
-        '''take a picture with the webcam and save it to a file
-        the resolution of the picture is set by the resolution parameter'''
-        # flush the frames to get the most recent picture
-        if self.first_frame == False: # we don't need to flush the first frame
-            self.flush_frames()
-            print("flushed frames")
-        self.first_frame = False
-        ret, frame = self.cap.read()
-        if ret:
-            cv2.imwrite(filename, frame)
-            print(f"picture saved to {filename}")
+        # latest frame buffer, only the newest frame is kept
+        self.frame = None
+        self.frame_time:float|None = None # time.time() when the frame was read
+        self.frame_count:int = 0
+        self._frame_ready = threading.Condition()
+        self._stop_grabber = threading.Event()
+        self._grabber = threading.Thread(target=self._grab_frames, daemon=True)
+        self._grabber.start()
+
+    def _grab_frames(self):
+        '''continuously read frames from the webcam and keep the newest one with its timestamp'''
+        while not self._stop_grabber.is_set():
+            ret, frame = self.cap.read()
+            frame_time = time.time()
+            if not ret:
+                time.sleep(0.01) # camera not ready (or unplugged), don't spin
+                continue
+            with self._frame_ready:
+                self.frame = frame
+                self.frame_time = frame_time
+                self.frame_count += 1
+                self._frame_ready.notify_all()
+
+    def get_frame(self, after:float|None=None, timeout:float=3.0):
+        '''return the newest (frame, frame_time) from the grabber thread
+        if after is given, wait for a frame read at or after that time (ex. the end of a beamscan)
+        returns (None, None) if no frame arrives within the timeout'''
+        with self._frame_ready:
+            ok = self._frame_ready.wait_for(
+                lambda: self.frame is not None and (after is None or self.frame_time >= after), timeout)
+            if not ok:
+                return None, None
+            return self.frame, self.frame_time
+
+    def take_picture(self, filename, after:float|None=None, writer:ArtifactWriter|None=None):
+        '''save the newest frame from the webcam to a file
+        the resolution of the picture is set by the resolution parameter
+        if a writer is given the jpeg is encoded and written off-thread (see writer.wait())
+        returns the time the frame was read, or None if no frame was available'''
+        frame, frame_time = self.get_frame(after=after)
+        if frame is not None:
+            if writer is not None:
+                writer.submit_image(frame, filename) # the grabber never modifies a frame after it is read
+            else:
+                write_image(frame, filename)
+                print(f"picture saved to {filename}")
         else:
             print("failed to take picture")
-
-    def flush_frames(self, num_frames=10):
-        '''Read and discard a number of frames to clear the buffer.'''
-        for _ in range(num_frames):
-            self.cap.read()
+        return frame_time
 
     def release(self):
+        self._stop_grabber.set()
+        self._grabber.join(timeout=2)
         self.cap.release()
 
 def take_test_picture(filename):
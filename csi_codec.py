@@ -0,0 +1,219 @@
+# this is a lossless compressed archive format for the beamscan csi data (the list of per packet dicts)
+# the complex64 csi of the packets (any length, a zmq message can hold several 52 value vectors) is
+# concatenated and split into chunks of packets, each chunk is byte-shuffled (the 4 bytes of every
+# float32 are grouped, the sign/exponent bytes compress very well) and compressed with zstd, lz4 or zlib
+# the packet metadata (pdu, beam, timestamp) is stored as json in the index at the end of the file
+
+# file layout:
+#   MAGIC | chunk 0 | chunk 1 | ... | index (zlib compressed json) | index offset <Q | MAGIC
+#   the index holds the codec, the chunk offsets/lengths, the csi length and the metadata of every packet,
+#   so a chunk (or the packets of one beam) is read without decompressing the rest of the file
+
+# usage:
+#   save_csi_archive(csi_data, f"{base}_beamscan_csi.csiz")
+#   csi_data = load_csi_data(filename) # .csiz archive or the original pickle, detected by the magic bytes
+#   archive = CSIArchive(filename); archive.read_beam(theta=15, phi=40)
+
+import json
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b"CSIZ\x00\x01\r\n" # the \r\n catches text mode transfers
+VERSION = 2 # version 1 archives (one csi length for all packets, no 'csi_lengths') are still read
+ARCHIVE_SUFFIX = "_beamscan_csi.csiz"
+ARRAY_KEYS = ('csi', 'avg_csi') # stored in the compressed chunks, the other keys go to the json index
+
+
+def available_codecs() -> list[str]:
+    '''the codecs usable in this environment, best first'''
+    codecs = []
+    if zstandard is not None:
+        codecs.append('zstd')
+    if lz4 is not None:
+        codecs.append('lz4')
+    codecs.append('zlib') # always available
+    return codecs
+
+def compress(data:bytes, codec:str, level:int|None=None) -> bytes:
+    '''compress the bytes with the codec ('zstd', 'lz4' or 'zlib')'''
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    raise ValueError(f"Unknown codec: {codec}, available: {available_codecs()}")
+
+def decompress(data:bytes, codec:str) -> bytes:
+    '''decompress bytes compressed with compress()'''
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("The archive is zstd compressed, install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ImportError("The archive is lz4 compressed, install the lz4 package")
+        return lz4.frame.decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
+
+def shuffle(array:np.ndarray, itemsize:int=4) -> bytes:
+    '''byte-shuffle an array: byte 0 of every item, then byte 1, ... (itemsize 4 = float32 parts of complex64)'''
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+def unshuffle(data:bytes, dtype:np.dtype, shape:tuple, itemsize:int=4) -> np.ndarray:
+    '''invert shuffle()'''
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(planes.T).reshape(-1).view(dtype).reshape(shape)
+
+
+def save_csi_archive(csi_data:list[dict], filename:str, codec:str|None=None, chunk_size:int=256,
+                     level:int|None=None) -> dict:
+    '''write the beamscan csi data as a compressed archive
+    codec: 'zstd', 'lz4' or 'zlib', default the best available
+    chunk_size: packets per chunk (the unit of random access)
+    returns the index of the archive'''
+    codec = available_codecs()[0] if codec is None else codec
+    n_packets = len(csi_data)
+
+    # the lost packets have no csi (length 0) and a NaN avg_csi, the valid flags restore the None
+    csi_lengths = [0 if entry.get('csi') is None else len(entry['csi']) for entry in csi_data]
+    csi_offsets = np.concatenate([[0], np.cumsum(csi_lengths, dtype=np.int64)])
+    csi = np.empty(csi_offsets[-1], dtype=np.complex64)
+    avg_csi = np.full(n_packets, np.nan, dtype=np.complex64)
+    packets = []
+    for ii, entry in enumerate(csi_data):
+        meta = {key: value for key, value in entry.items() if key not in ARRAY_KEYS}
+        meta['_valid'] = [entry.get(key) is not None for key in ARRAY_KEYS]
+        if entry.get('csi') is not None:
+            csi[csi_offsets[ii]:csi_offsets[ii + 1]] = np.asarray(entry['csi']).reshape(-1)
+        if entry.get('avg_csi') is not None:
+            avg_csi[ii] = entry['avg_csi']
+        packets.append(meta)
+
+    chunks = []
+    with open(filename, 'wb') as file:
+        file.write(MAGIC)
+        for start in range(0, n_packets, chunk_size):
+            stop = min(start + chunk_size, n_packets)
+            block = compress(shuffle(csi[csi_offsets[start]:csi_offsets[stop]]) + shuffle(avg_csi[start:stop]),
+                             codec, level)
+            chunks.append([file.tell(), len(block), start, stop])
+            file.write(block)
+        index = {'format': 'csi_archive', 'version': VERSION, 'codec': codec, 'n_packets': n_packets,
+                 'csi_lengths': csi_lengths, 'chunk_size': chunk_size, 'chunks': chunks, 'packets': packets}
+        index_offset = file.tell()
+        file.write(zlib.compress(json.dumps(index, default=_json_default).encode('utf-8')))
+        file.write(struct.pack('<Q', index_offset) + MAGIC)
+    return index
+
+def _json_default(value):
+    '''numpy scalars in the packet metadata (ex. beam angles) are stored as python numbers'''
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value)} in the csi archive index")
+
+
+class CSIArchive():
+    '''Random access reader of a csi archive, chunks are read and decompressed on demand'''
+    def __init__(self, filename:str):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a csi archive")
+            file.seek(-(8 + len(MAGIC)), 2)
+            index_offset, = struct.unpack('<Q', file.read(8))
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is truncated")
+            file.seek(index_offset)
+            self.index = json.loads(zlib.decompress(file.read()[:-(8 + len(MAGIC))]))
+        self.codec = self.index['codec']
+        self.packets = self.index['packets']
+        if 'csi_lengths' in self.index:
+            self.csi_lengths = np.asarray(self.index['csi_lengths'], dtype=np.int64)
+        else: # version 1, every packet has n_subcarriers values (NaN for lost packets)
+            self.csi_lengths = np.full(len(self.packets), self.index['n_subcarriers'], dtype=np.int64)
+        self.csi_offsets = np.concatenate([[0], np.cumsum(self.csi_lengths)])
+
+    def __len__(self):
+        return self.index['n_packets']
+
+    def read_chunk(self, chunk:int) -> tuple[list[np.ndarray], np.ndarray]:
+        '''the csi (one complex64 array per packet, empty for lost packets) and the avg_csi (n,) complex64
+        array (NaN for lost packets) of a chunk'''
+        offset, length, start, stop = self.index['chunks'][chunk]
+        with open(self.filename, 'rb') as file:
+            file.seek(offset)
+            data = decompress(file.read(length), self.codec)
+        n_values = int(self.csi_offsets[stop] - self.csi_offsets[start])
+        flat = unshuffle(data[:n_values * 8], np.complex64, (n_values,)) # 8 bytes per complex64
+        avg_csi = unshuffle(data[n_values * 8:], np.complex64, (stop - start,))
+        csi = np.split(flat, self.csi_offsets[start + 1:stop] - self.csi_offsets[start])
+        return csi, avg_csi
+
+    def read_csi(self, start:int=0, stop:int|None=None) -> tuple[list[np.ndarray], np.ndarray]:
+        '''the csi arrays and the avg_csi array of packets [start, stop), only the overlapping chunks
+        are decompressed'''
+        stop = len(self) if stop is None else min(stop, len(self))
+        csi = []
+        avg_csi = np.empty(max(stop - start, 0), dtype=np.complex64)
+        for chunk, (_, _, chunk_start, chunk_stop) in enumerate(self.index['chunks']):
+            if chunk_stop <= start or chunk_start >= stop:
+                continue
+            chunk_csi, chunk_avg = self.read_chunk(chunk)
+            lo = max(start, chunk_start); hi = min(stop, chunk_stop)
+            csi.extend(chunk_csi[lo - chunk_start:hi - chunk_start])
+            avg_csi[lo - start:hi - start] = chunk_avg[lo - chunk_start:hi - chunk_start]
+        return csi, avg_csi
+
+    def to_list(self, start:int=0, stop:int|None=None) -> list[dict]:
+        '''rebuild the per packet dicts of packets [start, stop) as saved by the experiment manager'''
+        stop = len(self) if stop is None else min(stop, len(self))
+        csi, avg_csi = self.read_csi(start, stop)
+        entries = []
+        for ii in range(start, stop):
+            entry = dict(self.packets[ii])
+            valid = entry.pop('_valid')
+            entry['csi'] = csi[ii - start].copy() if valid[0] else None
+            entry['avg_csi'] = avg_csi[ii - start] if valid[1] else None
+            entries.append(entry)
+        return entries
+
+    def beam_indices(self, theta:float, phi:float) -> list[int]:
+        '''the packet indices of a beam'''
+        return [ii for ii, packet in enumerate(self.packets)
+                if packet['beam']['theta'] == theta and packet['beam']['phi'] == phi]
+
+    def read_beam(self, theta:float, phi:float) -> list[dict]:
+        '''the packets of one beam (the packets of a beam are consecutive, one or two chunks are read)'''
+        indices = self.beam_indices(theta, phi)
+        if not indices:
+            return []
+        entries = self.to_list(indices[0], indices[-1] + 1)
+        return [entries[ii - indices[0]] for ii in indices]
+
+
+def is_csi_archive(filename:str) -> bool:
+    '''True if the file starts with the csi archive magic bytes'''
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def load_csi_data(filename:str) -> list[dict]:
+    '''load the beamscan csi data from a csi archive or the original pickle file'''
+    if is_csi_archive(filename):
+        return CSIArchive(filename).to_list()
+    with open(filename, 'rb') as file:
+        return pickle.load(file)
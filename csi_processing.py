@@ -0,0 +1,145 @@
+# this turns the per subcarrier csi of a beamscan into power delay profiles and an angle-delay map
+# the 52 used subcarriers of each packet (802.11a/g, -26..-1 and 1..26, the DC carrier is not used) are placed
+# on the (zero padded) FFT grid and transformed with one batched IFFT for all the packets of the scan,
+# the delay power of the packets of a beam is averaged (non-coherently, the packets have random phase offsets)
+
+# usage:
+#   result = angle_delay_map(csi_data, samp_rate=10e6)
+#   result['power'] # (beams, delays) delay power per beam, result['delay'] in seconds
+
+import numpy as np
+
+NUM_SUBCARRIERS = 52
+# the FFT bin of each csi value (order of the equalizer output), negative bins wrap around
+SUBCARRIER_INDEX:np.ndarray = np.concatenate([np.arange(-26, 0), np.arange(1, 27)])
+FFT_SIZE = 64 # the OFDM FFT size, the bin spacing is samp_rate / FFT_SIZE
+
+
+def stack_csi(csi_data:list[dict]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''collect the csi of the received packets into arrays
+    a packet may hold several 52 value csi vectors (one zmq message), they are kept as separate rows
+    returns theta_phi (rows, 2) degrees, csi (rows, 52) complex64, packet (rows,) index into csi_data'''
+    theta_phi = []; csi = []; packet = []
+    for ii, entry in enumerate(csi_data):
+        if entry.get('csi') is None or len(entry['csi']) % NUM_SUBCARRIERS:
+            continue
+        rows = np.asarray(entry['csi'], dtype=np.complex64).reshape(-1, NUM_SUBCARRIERS)
+        csi.append(rows)
+        theta_phi.extend([(entry['beam']['theta'], entry['beam']['phi'])] * len(rows))
+        packet.extend([ii] * len(rows))
+    if not csi:
+        raise ValueError("No csi data")
+    return np.asarray(theta_phi, dtype=np.float64), np.concatenate(csi), np.asarray(packet)
+
+def power_delay_profile(csi:np.ndarray, n_fft:int=FFT_SIZE, window:str|None='hann') -> np.ndarray:
+    '''batched power delay profile |IFFT(H)|^2 of csi rows (..., 52) on an n_fft point delay grid
+    n_fft > 64 zero pads the spectrum (finer delay sampling, same resolution)
+    window: 'hann' tapers the band edges (lower delay sidelobes) or None'''
+    if n_fft < FFT_SIZE:
+        raise ValueError(f"n_fft must be at least {FFT_SIZE}")
+    H = np.asarray(csi, dtype=np.complex64)
+    if window == 'hann':
+        H = H * np.hanning(NUM_SUBCARRIERS + 2)[1:-1].astype(np.float32) # no zero weights at the edges
+    elif window is not None:
+        raise ValueError("window must be 'hann' or None")
+    spectrum = np.zeros(H.shape[:-1] + (n_fft,), dtype=np.complex64)
+    spectrum[..., SUBCARRIER_INDEX % n_fft] = H
+    taps = np.fft.ifft(spectrum, axis=-1)
+    return (taps.real**2 + taps.imag**2).astype(np.float32)
+
+def delay_axis(n_fft:int=FFT_SIZE, samp_rate:float=10e6) -> np.ndarray:
+    '''the delay of each power delay profile tap in seconds (tap spacing 1 / (samp_rate * n_fft / 64))'''
+    return np.arange(n_fft) * FFT_SIZE / (n_fft * samp_rate)
+
+def beam_average(theta_phi:np.ndarray, values:np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''average the rows of values per beam (same theta, phi)
+    returns the unique theta_phi (beams, 2), the mean values (beams, ...) and the rows per beam'''
+    beams, inverse, counts = np.unique(theta_phi, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    sums = np.zeros((len(beams),) + values.shape[1:], dtype=np.float64)
+    np.add.at(sums, inverse, values)
+    return beams, sums / counts.reshape((-1,) + (1,) * (values.ndim - 1)), counts
+
+def angle_delay_map(csi_data:list[dict], samp_rate:float=10e6, n_fft:int=FFT_SIZE,
+                    window:str|None='hann', max_delay:float|None=None) -> dict:
+    '''the angle-delay map of a beamscan: the mean power delay profile of every beam
+    max_delay: keep the taps up to this delay (seconds), default all (the delay wraps after 64 / samp_rate)
+    returns {'theta', 'phi', 'x', 'y' (beams,), 'delay' (delays,) seconds, 'power' (beams, delays),
+             'counts' (beams,) csi rows per beam}'''
+    theta_phi, csi, _ = stack_csi(csi_data)
+    pdp = power_delay_profile(csi, n_fft=n_fft, window=window)
+    beams, power, counts = beam_average(theta_phi, pdp)
+    delay = delay_axis(n_fft, samp_rate)
+    if max_delay is not None:
+        keep = delay <= max_delay
+        delay = delay[keep]; power = power[:, keep]
+    theta = np.deg2rad(beams[:, 0]); phi = np.deg2rad(beams[:, 1])
+    return {'theta': beams[:, 0], 'phi': beams[:, 1],
+            'x': np.sin(theta) * np.cos(phi), 'y': np.sin(theta) * np.sin(phi),
+            'delay': delay, 'power': power, 'counts': counts}
+
+
+# ------------------------------------------ ANGLE OF ARRIVAL ------------------------------------------
+
+def beam_magnitudes(csi_data:list[dict]) -> tuple[np.ndarray, np.ndarray]:
+    '''the mean |avg_csi| of every beam (lost packets are ignored), as GaussianProcess(aggregate=True) fits
+    returns theta_phi (beams, 2) degrees and the magnitudes (beams,)'''
+    theta_phi = np.array([(entry['beam']['theta'], entry['beam']['phi']) for entry in csi_data
+                          if entry.get('avg_csi') is not None], dtype=np.float64)
+    if len(theta_phi) == 0:
+        raise ValueError("No csi data")
+    magnitude = np.abs(np.array([entry['avg_csi'] for entry in csi_data if entry.get('avg_csi') is not None]))
+    beams, mean, _ = beam_average(theta_phi, magnitude)
+    return beams, mean
+
+def to_cartesian(theta_phi:np.ndarray) -> np.ndarray:
+    '''(theta, phi) degrees to the (x, y) plane of the GP images'''
+    theta = np.deg2rad(theta_phi[..., 0]); phi = np.deg2rad(theta_phi[..., 1])
+    return np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi)], axis=-1)
+
+def to_spherical(xy:np.ndarray) -> tuple[float, float]:
+    '''(x, y) back to (theta, phi) degrees, phi in [0, 360)'''
+    theta = np.rad2deg(np.arcsin(min(np.hypot(xy[0], xy[1]), 1.0)))
+    phi = np.rad2deg(np.arctan2(xy[1], xy[0])) % 360
+    return float(theta), float(phi)
+
+def estimate_aoa_xy(xy:np.ndarray, magnitude:np.ndarray, n_neighbors:int=8) -> dict:
+    '''angle of arrival from the beam magnitudes at the (x, y) beam positions
+    the strongest beam is refined by a quadratic fit of the log magnitude of it and its n_neighbors nearest
+    beams (a Gaussian beam shape), the vertex of the fit is the estimate if it is a maximum near the beam
+    returns {'theta', 'phi', 'x', 'y', 'magnitude', 'confidence', 'refined', 'peak_beam'}
+    confidence (0-1): the R^2 of the local fit (1 if not refined) times the peak contrast
+    (1 - median magnitude / peak magnitude)'''
+    xy = np.asarray(xy, dtype=np.float64); magnitude = np.asarray(magnitude, dtype=np.float64)
+    peak = int(np.argmax(magnitude))
+    contrast = 1.0 - np.median(magnitude) / magnitude[peak] if magnitude[peak] > 0 else 0.0
+    estimate = xy[peak]; refined = False; r2 = 1.0; peak_value = magnitude[peak]
+
+    if len(xy) >= 6: # a 2d quadratic has 6 coefficients
+        distance = np.sum((xy - xy[peak])**2, axis=1)
+        near = np.argsort(distance)[:min(n_neighbors + 1, len(xy))]
+        local = xy[near] - xy[peak] # centered for a well conditioned fit
+        log_mag = np.log(np.maximum(magnitude[near], 1e-12))
+        A = np.column_stack([np.ones(len(near)), local[:, 0], local[:, 1],
+                             local[:, 0]**2, local[:, 0] * local[:, 1], local[:, 1]**2])
+        coef, *_ = np.linalg.lstsq(A, log_mag, rcond=None)
+        hessian = np.array([[2 * coef[3], coef[4]], [coef[4], 2 * coef[5]]])
+        if len(near) > 6 and np.all(np.linalg.eigvalsh(hessian) < 0): # a maximum
+            vertex = np.linalg.solve(hessian, -coef[1:3])
+            if np.sum(vertex**2) <= distance[near].max(): # inside the neighbourhood, else extrapolated
+                estimate = xy[peak] + vertex; refined = True
+                residual = log_mag - A @ coef
+                r2 = max(0.0, 1.0 - np.sum(residual**2) / max(np.sum((log_mag - log_mag.mean())**2), 1e-30))
+                peak_value = float(np.exp(coef[0] + coef[1:3] @ vertex + 0.5 * vertex @ hessian @ vertex))
+    theta, phi = to_spherical(estimate)
+    return {'theta': theta, 'phi': phi, 'x': float(estimate[0]), 'y': float(estimate[1]),
+            'magnitude': float(peak_value), 'confidence': float(np.clip(r2 * contrast, 0.0, 1.0)),
+            'refined': refined, 'peak_beam': peak}
+
+def estimate_aoa(csi_data:list[dict], n_neighbors:int=8) -> dict:
+    '''angle of arrival of the strongest path of a beamscan, see estimate_aoa_xy
+    'peak_beam' is the (theta, phi) of the strongest beam'''
+    theta_phi, magnitude = beam_magnitudes(csi_data)
+    result = estimate_aoa_xy(to_cartesian(theta_phi), magnitude, n_neighbors=n_neighbors)
+    result['peak_beam'] = tuple(float(angle) for angle in theta_phi[result['peak_beam']])
+    return result
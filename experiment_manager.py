@@ -1,5 +1,6 @@
 # this is a class that unifies the experiment system into one object, ExperimentSystemManager
 
+import io
 import logging
 import logging.config
 import os
@@ -7,11 +8,16 @@ from pathlib import Path
 import platform
 import sys
 import time
+from dataclasses import replace
 import numpy as np
 import pickle
+import xmlrpc.client
+from scipy.spatial import QhullError
 from itertools import product
 
 import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # import warnings
 # warnings.filterwarnings("ignore") # ignore warnings from the GP
@@ -21,7 +27,12 @@ from tymtek_wrapper import TMY_service, UDBox, BBox5G # TymTek wrapper
 from gnu_manager import GNURadioManager # start and stop the GNU Radio process
 from trans import transceiver # send and receive data from the GNU Radio process
 from camera import Camera
-from gp import GaussianProcess
+from gp import GaussianProcess, InterpolationPreview, OnlineGaussianProcess, render_heatmap
+from csi_codec import save_csi_archive # compressed csi archives
+from csi_processing import angle_delay_map, estimate_aoa # power delay profiles, angle of arrival
+from scan_plan import ScanPlan, StageLatency, SteerTimeModel, pair_order # scan profiles, orderings, timing
+from artifact_writer import ArtifactWriter, write_atomic # off-thread image encoding/writing
+from artifact_store import ArtifactStore, ScanStaging, new_scan_id # deduplicating scan storage
 
 logging.basicConfig(
 level=logging.DEBUG, # change to INFO for runtime logging
@@ -73,13 +84,29 @@ class ExperimentSystemManager:
         self.transceiver:transceiver
         #--
         self.camera:Camera
+        self.camera_time:float|None = None # time.time() of the last saved camera frame
+        self.writer:ArtifactWriter = ArtifactWriter() # encodes and writes the images off the scan thread
 
         # experiment trial/run data
-        self.base_filename:str = time.strftime("%Y%m%d-%H%M%S")
+        self.base_filename:str = new_scan_id() # unique per scan (the scan id)
         self.csi_data:np.ndarray # the data from each beamscan run
         self.gp:GaussianProcess
+        self.online_gp:OnlineGaussianProcess|None = None # updated per beam during rx_beamscan
+        self.aoa:dict|None = None # angle of arrival estimate of the latest scan (see csi_processing.estimate_aoa)
+        self.track_state:dict|None = None # latest update of rx_track
+        self.joint_scan:dict|None = None # result of the latest joint_beamscan
+        self.steer_time:SteerTimeModel = SteerTimeModel() # learns the rx steering time over the scans
+        self.latency:StageLatency = StageLatency() # measured packet and per beam times (scan estimates)
+        self.plan:ScanPlan = ScanPlan() # the default rx_beamscan profile, its timings are used by every probe
+        self.beam_status:list[dict] = [] # per beam result of the latest rx_beamscan
+        self._track_stop:threading.Event|None = None
+        # the tx and rx bbox are steered concurrently in the joint sweep (each device call holds its device_lock)
+        self.steer_pool:ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="steer")
+        self.preview:InterpolationPreview = InterpolationPreview() # caches the weights of the beam layout
         self.datapath:str = "experiment_name" # relative path to save the data
         self.full_filename:str|None = None # the full filename for each run
+        self.store:ArtifactStore|None = None # if set, the scans are staged and committed to this store
+        self.staging:ScanStaging|None = None # the staging directory of the current scan (with a store)
 
         # experiment stats
         self.scan_start_times = [] #len = number of scans performed + 1
@@ -100,7 +127,8 @@ class ExperimentSystemManager:
         # path = "/home/sunlab/radioconda/share/gnuradio/examples/ieee802_11"
         path = "ieee802_11"
         python_filename = "wifi_transceiver_nogui.py"
-        gnu_service = GNURadioManager(conda_env=conda_env, path=path, python_filename=python_filename)
+        gnu_service = GNURadioManager(conda_env=conda_env, path=path, python_filename=python_filename,
+                                      control_port=64002) # xmlrpc_server block in the flowgraph
         gnu_service.start()
         self.gnu_service = gnu_service
 
@@ -142,72 +170,350 @@ class ExperimentSystemManager:
         trans = transceiver(tx_port=64001, rx_port=64000)
         self.transceiver = trans
 
-    def rx_beamscan(self, packets_per_beam:int=2):
-        '''perform a beamscan using the bbox devices and the GNU Radio process
-        returns a list of dictionaries containing the beam data'''
-        # update the experiment stats and base filename
-        self.scan_start_times.append(time.time())
-        self.base_filename = time.strftime("%Y%m%d-%H%M%S")
-        self.full_filename = f"{self.datapath}/{self.base_filename}"
+    def retune_radio(self, **variables):
+        '''change flowgraph variables (freq, tx_gain, rx_gain, encoding, chan_est, ...) of the running
+        GNU Radio process over its control channel, no restart needed
+        ex. esm.retune_radio(tx_gain=0.7, rx_gain=0.3)'''
+        retune_time = self.gnu_service.set_variables(**variables)
+        logger.info(f"Retuned GNU Radio {variables} in {retune_time*1000:.1f} ms")
 
+    def rx_beamscan(self, plan:ScanPlan|None=None, deadline:float|None=None, online_gp:bool=False,
+                    retries:int=1):
+        '''perform a beamscan using the bbox devices and the GNU Radio process
+        returns a list of dictionaries containing the beam data
+        plan: the scan profile (raster, order, packets per beam, timings), default self.plan
+        deadline: coarsen the plan to finish within this many seconds (predicted from the measured latencies)
+        online_gp: feed each beam to self.online_gp (fixed hyperparameters), its current() mean/std
+            is a usable map during the scan (vis_gp_heatmap(online=True)), off by default: it holds ~100 MB
+            and adds a rank-one update over the whole grid to every beam of the timed scan
+        retries: passes over the failed beams (not steered or no csi received) after the scan, the status of
+            every beam {'theta', 'phi', 'status' ('ok', 'steer_failed', 'csi_timeout'), 'attempts'} is kept
+            in self.beam_status, with a deadline a retry pass only runs if its estimate fits the time left'''
+        call_time = time.time() # the deadline counts from the call, planning included
+        plan = self.plan if plan is None else plan
+        if deadline is not None:
+            plan = plan.fit_to_deadline(deadline, self.rxbbox.raster_beams, self.steer_time, self.latency)
+        else:
+            plan.compile(self.rxbbox.raster_beams)
+        if plan.beams is None: logger.error("Failed to generate the scan raster");exit(1)
+        logger.info(f"Scan plan: {plan} {len(plan.beams)} beams, "
+                    f"estimated {plan.estimate_duration(self.steer_time, self.latency):.2f} seconds")
+        self._begin_scan()
         csi_data = []
-        theta_step = 5; phi_step = 20
-        rx_scanner = self.rxbbox.scan_raster_generator(theta_step=theta_step, phi_step=phi_step)
-        # check if the scanner is did not return None (indicating an error), primes the scanner(generator)
-        if rx_scanner is None: logger.error("Failed to generate the scan raster");exit(1)
+        self.csi_data = csi_data # filled while scanning, save_preview can be called from another thread
+        self.online_gp = OnlineGaussianProcess(mask_cone=True) if online_gp else None
+        self.beam_status = [{'theta': float(theta), 'phi': float(phi), 'status': None, 'attempts': 0}
+                            for theta, phi in plan.beams]
 
         # BEAMSCAN --------------------------------------------------------------------------
         logger.info("Performing beamscan")
         start_time = time.time()
         self.scan_start_times.append(start_time)
-        for i, scanning in enumerate(rx_scanner):
-            logger.debug(f'beam {i}: scanning {scanning}')
-            if scanning is None: logger.info("scan ended");break # break if the scan is complete
-            # transmit and receive a packet
-            beam_data = {}
-            for ii in range(packets_per_beam):
-                pdu = f"HELLO SUNLAB {ii+1}!"
-                beam_data['pdu'] = pdu
-                beam_data['beam'] = self.rxbbox.beam # store the beam [gain, theta, phi]
-                logger.debug(f"Transmitting packet: {pdu}")
-                self.transceiver.send(pdu)
-                beam_data['timestamp'] = time.time()
-                time.sleep(0.001) # 1ms
-                rx = self.transceiver.recieve_csi(timeout=7) # timeout in ms
-                if rx is not None:
-                    logger.debug("Received CSI data")
-                    beam_data['csi'] = rx
-                    # process the CSI data into an average
-                    avg_csi = np.mean(rx, axis=0)
-                    beam_data['avg_csi'] = avg_csi
-                    logger.debug(f'avg_csi: {avg_csi}')
-                else:
-                    logger.debug("Failed to receive CSI data")
-                    beam_data['csi'] = None
-                    beam_data['avg_csi'] = None
-                csi_data.append(beam_data)
-                time.sleep(0.010) # 10ms
+        pending = list(range(len(plan.beams))) # indices into plan.beams
+        timed_out:dict[int, list[dict]] = {} # the packets of the latest attempt of the csi_timeout beams
+        for attempt in range(retries + 1):
+            if attempt > 0 and deadline is not None: # the plan was sized for one pass
+                retry_time = replace(plan, beams=[plan.beams[ii] for ii in pending]).estimate_duration(
+                    self.steer_time, self.latency)
+                if time.time() - call_time + retry_time > deadline:
+                    logger.warning(f"Skipping the retry of {len(pending)} beams, {retry_time:.2f} seconds "
+                                   f"would overrun the {deadline} second deadline")
+                    break
+            pending = self._scan_pass(plan, pending, csi_data, timed_out)
+            if not pending:
+                break
+            logger.warning(f"{len(pending)} beams failed in pass {attempt+1}"
+                           + (", retrying" if attempt < retries else ""))
+        for ii in pending: # still without csi after the retries, keep one set of (lost) packets per beam
+            csi_data.extend(timed_out.get(ii, []))
+        if self.beam_status and all(status['attempts'] == 0 for status in self.beam_status):
+            logger.error("The rx bbox did not scan (setup not complete)")
         end_time = time.time()
         beamscan_time = end_time - start_time
-        logger.info(f"Time taken: {beamscan_time} seconds")
+        logger.info(f"Time taken: {beamscan_time} seconds, "
+                    f"{sum(status['status'] == 'ok' for status in self.beam_status)} of {len(plan.beams)} beams ok")
         self.csi_data = csi_data
-
-    
-    def vis_gp_heatmap(self):
+        try: # the dominant direction without the GP, a fraction of a millisecond
+            self.aoa = estimate_aoa(csi_data)
+            logger.info(f"AoA estimate: theta {self.aoa['theta']:.1f}, phi {self.aoa['phi']:.1f} "
+                        f"(confidence {self.aoa['confidence']:.2f})")
+        except ValueError: # no packet received
+            self.aoa = None
+
+    def _scan_pass(self, plan:ScanPlan, indices:list[int], csi_data:list[dict],
+                   timed_out:dict[int, list[dict]]) -> list[int]:
+        '''scan the beams plan.beams[indices] in the listed order and update self.beam_status
+        the packets of the beams with csi are appended to csi_data, the (all lost) packets of a csi_timeout
+        beam are kept in timed_out[index] instead (a retry replaces them, so a scan never holds more than
+        packets_per_beam packets per beam), returns the indices of the beams that failed'''
+        failed = []
+        rx_scanner = self.rxbbox.scan_raster_generator(theta_step=plan.theta_step, phi_step=plan.phi_step,
+                                                       beams=[plan.beams[ii] for ii in indices],
+                                                       steer_time=self.steer_time)
+        for jj, ok in rx_scanner:
+            ii = indices[jj]; status = self.beam_status[ii]
+            status['attempts'] += 1
+            if not ok: # the beam was not set, the scan continues with the next one
+                status['status'] = 'steer_failed'; failed.append(ii)
+                continue
+            # transmit and receive the packets of the beam
+            entries = self._measure_beam(plan.packets_per_beam, plan)
+            if all(entry['csi'] is None for entry in entries):
+                status['status'] = 'csi_timeout'; failed.append(ii)
+                timed_out[ii] = entries
+                continue
+            csi_data.extend(entries); timed_out.pop(ii, None)
+            status['status'] = 'ok'
+            beam_start = time.perf_counter()
+            if self.online_gp is not None: # rank-one update with the packets of this beam
+                self.online_gp.add_packets(entries)
+            self.latency.observe('beam', time.perf_counter() - beam_start)
+        return failed
+
+    def _begin_scan(self):
+        '''update the experiment stats and the base filename (scan id) of a new scan'''
+        self.scan_start_times.append(time.time())
+        self.base_filename = new_scan_id()
+        self.beam_status = []
+        if self.store is not None: # the artifacts are written to a staging directory until commit_scan
+            self.staging = self.store.begin_scan(self.base_filename)
+            self.full_filename = self.staging.base
+        else:
+            self.full_filename = f"{self.datapath}/{self.base_filename}"
+
+    def _steer_pair(self, tx_beam:tuple[float, float], rx_beam:tuple[float, float],
+                    current:tuple|None=None) -> bool:
+        '''steer the tx and rx bbox to their beams concurrently (one call per device at a time, see
+        TMY_Device.device_lock), a device already on its beam (current = (tx_beam, rx_beam) of the previous
+        pair) is not steered again
+        returns True if both are on their beam'''
+        futures = []
+        if current is None or tx_beam != current[0]:
+            futures.append(self.steer_pool.submit(self.txbbox.set_beam_angle, self.txbbox.beam_gain, *tx_beam))
+        if current is None or rx_beam != current[1]:
+            futures.append(self.steer_pool.submit(self.rxbbox.set_beam_angle, self.rxbbox.beam_gain, *rx_beam))
+        return all([future.result() for future in futures]) # wait for both
+
+    def joint_beamscan(self, theta_step:float=10, phi_step:float=45, tx_theta_step:float|None=None,
+                       tx_phi_step:float|None=None, order:str='grid', packets_per_beam:int=1) -> dict:
+        '''sweep the tx x rx beam pairs, both bbox are steered concurrently when both beams change
+        the rx raster uses theta_step/phi_step, the tx raster tx_theta_step/tx_phi_step (default the same)
+        order: 'grid' (tx-major), 'rx_major' or 'hierarchical' (coarse to fine), see scan_plan.pair_order
+        returns (and keeps in self.joint_scan) {'tx_beams', 'rx_beams' (n, 2) theta/phi, 'order',
+            'csi' (n_tx, n_rx, 52) complex64 the first received csi of each pair (NaN if none),
+            'counts' (n_tx, n_rx) received packets, 'failed' pairs not steered, 'csi_data' all the packets}'''
+        self._begin_scan()
+        rx_beams = self.rxbbox.raster_beams(theta_step=theta_step, phi_step=phi_step)
+        tx_beams = self.txbbox.raster_beams(theta_step=theta_step if tx_theta_step is None else tx_theta_step,
+                                            phi_step=phi_step if tx_phi_step is None else tx_phi_step)
+        if rx_beams is None or tx_beams is None:
+            raise ValueError("Failed to generate the scan rasters")
+        pairs = pair_order(len(tx_beams), len(rx_beams), order=order)
+        csi = np.full((len(tx_beams), len(rx_beams), 52), np.nan, dtype=np.complex64)
+        counts = np.zeros((len(tx_beams), len(rx_beams)), dtype=np.int32)
+        csi_data = []; failed = []
+        logger.info(f"Joint beamscan: {len(tx_beams)} tx x {len(rx_beams)} rx beams, {len(pairs)} pairs ({order})")
+        start_time = time.time()
+        current = None
+        for tx, rx in pairs:
+            if not self._steer_pair(tx_beams[tx], rx_beams[rx], current):
+                logger.error(f"Failed to steer the pair tx {tx_beams[tx]}, rx {rx_beams[rx]}")
+                failed.append((tx, rx)); current = None # steer both again for the next pair
+                continue
+            current = (tx_beams[tx], rx_beams[rx])
+            for entry in self._measure_beam(packets_per_beam):
+                entry['tx_beam'] = self.txbbox.beam
+                csi_data.append(entry)
+                if entry['csi'] is not None and len(entry['csi']) >= 52:
+                    if counts[tx, rx] == 0:
+                        csi[tx, rx] = entry['csi'][:52]
+                    counts[tx, rx] += 1
+        logger.info(f"Joint beamscan time taken: {time.time() - start_time} seconds, {len(failed)} pairs failed")
+        self.txbbox.boresight() # the tx bbox is parked at boresight for the rx scans
+        self.joint_scan = {'tx_beams': np.array(tx_beams, dtype=np.float64),
+                           'rx_beams': np.array(rx_beams, dtype=np.float64), 'order': order,
+                           'csi': csi, 'counts': counts, 'failed': failed, 'csi_data': csi_data}
+        return self.joint_scan
+
+    def save_joint_scan(self):
+        '''save the latest joint beamscan cube as _joint_csi.npz (tx_beams, rx_beams, csi, counts)'''
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, tx_beams=self.joint_scan['tx_beams'], rx_beams=self.joint_scan['rx_beams'],
+                            csi=self.joint_scan['csi'], counts=self.joint_scan['counts'])
+        write_atomic(f'{self.full_filename}_joint_csi.npz', buffer.getvalue())
+        logger.info(f"Joint scan saved to {self.full_filename}_joint_csi.npz")
+
+    def _measure_beam(self, packets_per_beam:int, plan:ScanPlan|None=None) -> list[dict]:
+        '''transmit packets_per_beam packets at the current rx beam and collect their CSI
+        the sleeps and the csi timeout are those of the plan (default self.plan)
+        returns one dictionary per packet (pdu, beam, timestamp, csi, avg_csi), csi is None if not received'''
+        plan = self.plan if plan is None else plan
+        entries = []
+        for ii in range(packets_per_beam):
+            packet_start = time.perf_counter()
+            beam_data = {} # one entry per packet
+            pdu = f"HELLO SUNLAB {ii+1}!"
+            beam_data['pdu'] = pdu
+            beam_data['beam'] = self.rxbbox.beam # store the beam [gain, theta, phi]
+            logger.debug(f"Transmitting packet: {pdu}")
+            self.transceiver.send(pdu)
+            beam_data['timestamp'] = time.time()
+            time.sleep(plan.tx_gap)
+            rx = self.transceiver.recieve_csi(timeout=plan.csi_timeout) # timeout in ms
+            if rx is not None:
+                logger.debug("Received CSI data")
+                beam_data['csi'] = rx
+                # process the CSI data into an average
+                avg_csi = np.mean(rx, axis=0)
+                beam_data['avg_csi'] = avg_csi
+                logger.debug(f'avg_csi: {avg_csi}')
+            else:
+                logger.debug("Failed to receive CSI data")
+                beam_data['csi'] = None
+                beam_data['avg_csi'] = None
+            entries.append(beam_data)
+            time.sleep(plan.packet_gap)
+            self.latency.observe('packet', time.perf_counter() - packet_start)
+        return entries
+
+    def _probe_beam(self, theta:float, phi:float, packets_per_beam:int) -> list[dict]|None:
+        '''steer the rx bbox to (theta, phi) and measure it, None if the beam could not be set'''
+        if not self.rxbbox.set_beam_angle(self.rxbbox.beam_gain, theta, phi):
+            return None
+        return self._measure_beam(packets_per_beam)
+
+    def rx_track(self, start:tuple[float, float]|None=None, theta_step:float=2.0, phi_step:float=10.0,
+                 radius:int=1, diagonal:bool=False, packets_per_beam:int=1, rate:float=5.0,
+                 duration:float|None=None, cycles:int|None=None, callback=None) -> tuple[float, float]:
+        '''keep the rx beam on the strongest direction with a local search
+        every cycle the current best beam and its neighbourhood (BBox5G.neighbourhood) are probed,
+        the strongest becomes the new center and the rx bbox is left on it until the next cycle
+        start: (theta, phi) of the first center, default the AoA of the latest scan (else boresight)
+        rate: cycles per second (at most, a cycle takes the time of its 1 + 4*radius beam steers,
+            a ring of 360/phi_step beams per radius step at boresight)
+        duration/cycles: stop after this many seconds/cycles, else run until stop_tracking()
+        callback: called every cycle with the update {'time', 'cycle', 'theta', 'phi', 'magnitude',
+            'moved', 'latency', 'probes': {(theta, phi): magnitude}, 'csi_data'}, also kept in self.track_state
+        returns the last (theta, phi)'''
+        if start is None:
+            start = (self.aoa['peak_beam'] if self.aoa is not None else (0, 0))
+        center = (float(start[0]), float(start[1]))
+        self._track_stop = threading.Event()
+        period = 1.0 / rate
+        start_time = time.time(); cycle = 0
+        logger.info(f"Tracking from theta {center[0]}, phi {center[1]} at {rate} Hz")
+        while not self._track_stop.is_set():
+            cycle_start = time.time()
+            probes = {}; csi_data = []
+            for theta, phi in self.rxbbox.neighbourhood(center[0], center[1], theta_step=theta_step,
+                                                        phi_step=phi_step, radius=radius, diagonal=diagonal):
+                entries = self._probe_beam(theta, phi, packets_per_beam)
+                if entries is None:
+                    continue
+                csi_data.extend(entries)
+                magnitudes = [np.abs(entry['avg_csi']) for entry in entries if entry['avg_csi'] is not None]
+                if magnitudes:
+                    probes[(theta, phi)] = float(np.mean(magnitudes))
+            moved = False
+            if probes:
+                best = max(probes, key=probes.get)
+                moved = best != center
+                center = best
+            self.rxbbox.set_beam_angle(self.rxbbox.beam_gain, center[0], center[1]) # stay on the best beam
+            latency = time.time() - cycle_start
+            self.track_state = {'time': cycle_start, 'cycle': cycle, 'theta': center[0], 'phi': center[1],
+                                'magnitude': probes.get(center), 'moved': moved, 'latency': latency,
+                                'probes': probes, 'csi_data': csi_data}
+            logger.debug(f"Track cycle {cycle}: theta {center[0]}, phi {center[1]}, "
+                         f"{len(probes)} beams in {latency*1000:.1f} ms")
+            if callback is not None:
+                callback(self.track_state)
+            cycle += 1
+            if (cycles is not None and cycle >= cycles) or \
+                    (duration is not None and time.time() - start_time >= duration):
+                break
+            self._track_stop.wait(max(0.0, period - (time.time() - cycle_start))) # rate control
+        logger.info(f"Tracking stopped after {cycle} cycles at theta {center[0]}, phi {center[1]}")
+        return center
+
+    def stop_tracking(self):
+        '''stop rx_track (running in another thread) after its current cycle'''
+        if self._track_stop is not None:
+            self._track_stop.set()
+
+    def vis_gp_heatmap(self, html_mode:str='report', online:bool=False):
         '''visualize the csi data as a heatmap using a gaussian process model
-        and save the images to a file'''
-        gp = GaussianProcess(self.csi_data)
+        and save the images to a file
+        html_mode: 'report' one compact html with all three plots (shared plotly.js in the datapath),
+        'standalone' three self-contained html files, 'none' no html
+        online: use the GP updated during the scan (no refit, fixed hyperparameters) if there is one'''
+        if online and self.online_gp is not None:
+            gp = self.online_gp
+        else:
+            gp = GaussianProcess(self.csi_data, mask_cone=True) # predict inside the steerable cone only
         gp.fit()
-        gp.save_image(data=gp.yy_pred, filename=f'{self.full_filename}_gp_heatmap.png')
-        gp.save_image(data=gp.yy_std, filename=f'{self.full_filename}_gp_heatmap_std.png')
-        gp.plot_scatter(filename=f'{self.full_filename}_scatter.html')
-        gp.plot_heatmap_gp(filename=f'{self.full_filename}_gp_heatmap.html')
-        gp.plot_heatmap_gp_std(filename=f'{self.full_filename}_gp_heatmap_std.html')
-        gp.save_pickle(filename=f'{self.full_filename}_gp.pkl')
-
-    def save_beamscan_data(self):
-        '''save the latest beamscan data to a pickle file'''
+        gp.save_image(data=gp.yy_pred, filename=f'{self.full_filename}_gp_heatmap.png', writer=self.writer)
+        gp.save_image(data=gp.yy_std, filename=f'{self.full_filename}_gp_heatmap_std.png', writer=self.writer)
+        if html_mode == 'report':
+            # one plotly.js bundle in the datapath, not one per scan (the staging and scan directories are
+            # both two levels below the datapath, the relative link holds after commit_scan)
+            gp.plot_report(filename=f'{self.full_filename}_plots.html', title=self.base_filename,
+                           plotlyjs_dir=self.datapath)
+        elif html_mode == 'standalone':
+            gp.plot_scatter(filename=f'{self.full_filename}_scatter.html')
+            gp.plot_heatmap_gp(filename=f'{self.full_filename}_gp_heatmap.html')
+            gp.plot_heatmap_gp_std(filename=f'{self.full_filename}_gp_heatmap_std.html')
+        gp.save_model(filename=f'{self.full_filename}_gp.npz') # compact model, load with gp.load_model
+
+    def save_preview(self) -> np.ndarray|None:
+        '''save a quick interpolated heatmap (_preview.png) of the (latest or running) beamscan, no GP fit
+        the first call per beam layout triangulates, then each preview takes well under a millisecond
+        returns None (nothing saved) until there are 3 beams that are not on one line'''
+        try:
+            yy_pred = self.preview.render(list(self.csi_data)) # a snapshot, the scan may be appending
+        except (ValueError, QhullError) as e: # no csi yet, or too few beams to triangulate
+            logger.info(f"No preview yet: {e}")
+            return None
+        self.preview.save_image(data=yy_pred, filename=f'{self.full_filename}_preview.png', writer=self.writer)
+        return yy_pred
+
+    def save_angle_delay_map(self, samp_rate:float|None=None, dynamic_range:float=40.0) -> dict|None:
+        '''IFFT the per subcarrier csi of every beam of the latest scan into its power delay profile and save
+        the angle-delay map as _angle_delay.npz (theta, phi, x, y, delay, power, counts) and as a png
+        (one row per beam sorted by theta then phi, delay to the right, dB scale over dynamic_range)
+        samp_rate: of the flowgraph (the delay axis), default read over the control channel, else 10e6
+        returns None (nothing saved) if no csi was received'''
+        if samp_rate is None:
+            try:
+                samp_rate = float(self.gnu_service.get_variable("samp_rate"))
+            except (OSError, RuntimeError, xmlrpc.client.Error) as e:
+                samp_rate = 10e6
+                logger.warning(f"Could not read samp_rate from the flowgraph ({e}), using {samp_rate:g}")
+        try:
+            result = angle_delay_map(self.csi_data, samp_rate=samp_rate)
+        except ValueError as e: # no csi in the scan
+            logger.warning(f"No angle-delay map: {e}")
+            return None
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **result)
+        write_atomic(f'{self.full_filename}_angle_delay.npz', buffer.getvalue())
+        peak = result['power'].max()
+        power_db = 10 * np.log10(result['power'] / peak + 1e-30) if peak > 0 else \
+                   np.full(result['power'].shape, -dynamic_range) # all zero csi
+        image = render_heatmap(power_db, vmin=-dynamic_range, vmax=0, origin='upper')
+        self.writer.submit_image(image, f'{self.full_filename}_angle_delay.png', rgb=True)
+        logger.info(f"Angle-delay map of {len(result['theta'])} beams x {len(result['delay'])} delays saved")
+        return result
+
+    def save_beamscan_data(self, compress:bool=False):
+        '''save the latest beamscan data to a pickle file
+        compress: save a lossless compressed csi archive (_beamscan_csi.csiz) instead, see csi_codec'''
         logger.info("len(csi_data): %d" %len(self.csi_data))
+        if compress:
+            filename = f'{self.full_filename}_beamscan_csi.csiz'
+            index = save_csi_archive(self.csi_data, filename)
+            logger.info(f"Data saved to {filename} ({index['codec']}, {os.path.getsize(filename)} bytes)")
+            return
         logger.info("Saving the data to a pickle file")
         filename = f'{self.full_filename}_beamscan_csi.pkl'
         with open(filename, 'wb') as file:
@@ -215,9 +521,31 @@ class ExperimentSystemManager:
         logger.info(f"Data saved to {filename}")
 
     def save_camera_image(self):
-        '''save an image from the camera'''
-        self.camera.take_picture(filename=f'{self.full_filename}_camera.jpg')
-
+        '''save an image from the camera (the newest frame buffered by the camera's grabber thread)'''
+        self.camera_time = self.camera.take_picture(filename=f'{self.full_filename}_camera.jpg', writer=self.writer)
+        if self.camera_time is not None:
+            logger.info(f"Camera frame taken {self.camera_time - self.scan_start_times[-1]:.3f} seconds after the scan start")
+
+
+    def wait_for_artifacts(self, timeout:float|None=None) -> bool:
+        '''wait until the queued images of the scan are written to disk'''
+        return self.writer.wait(timeout=timeout)
+
+    def commit_scan(self, timeout:float|None=None) -> dict|None:
+        '''wait for the queued images and commit the artifacts of the scan to the store at once
+        returns the manifest of the scan (None without a store)'''
+        if self.store is None or self.staging is None:
+            self.wait_for_artifacts(timeout=timeout)
+            return None
+        if not self.wait_for_artifacts(timeout=timeout):
+            logger.warning(f"Not all the artifacts of the scan were written (failed: {self.writer.failed}), "
+                           "committing the others")
+        meta = {'scan_start_time': self.scan_start_times[-1], 'camera_time': self.camera_time,
+                'beam_status': self.beam_status}
+        manifest = self.store.commit_scan(self.staging, meta=meta)
+        self.full_filename = os.path.join(self.store.scan_path(self.base_filename), self.base_filename)
+        self.staging = None
+        return manifest
 
     def shutdown(self):
         '''shutdown the system'''
@@ -226,6 +554,8 @@ class ExperimentSystemManager:
         self.gnu_service.stop() # stop the GNU Radio process
         self.transceiver.close()
         self.camera.release()
+        self.writer.shutdown() # finish writing any queued images
+        self.steer_pool.shutdown()
         logger.info("ExperimentSystemManager Shutdown complete")
 
 
@@ -237,14 +567,17 @@ if __name__ == "__main__":
     esm.datapath = "/home/sunlab/beamscan_data"
 
     print("waiting for GNU Radio to start")
-    time.sleep(5) # wait for the GNU Radio process to start
-    esm.gnu_service.poll()
+    if not esm.gnu_service.wait_ready(timeout=30): # returns as soon as the flowgraph is up
+        print("GNU Radio process failed to start, exiting.")
+        esm.shutdown()
+        exit(1)
 
     #check if the directory exists
     if not os.path.exists(esm.datapath):
         print(f"Directory {esm.datapath} does not exist.")
         os.makedirs(esm.datapath)
         print(f"Created directory {esm.datapath}")
+    esm.store = ArtifactStore(esm.datapath) # scans are committed to {datapath}/scans/<scan_id>/
     
     # catch the ctrl+c signal and shutdown the experiment system manager before exiting
     def signal_handler(sig, frame):
@@ -260,11 +593,13 @@ if __name__ == "__main__":
     print("=== Beamscan complete ===")
     esm.save_beamscan_data()
     esm.save_camera_image()
+    esm.save_angle_delay_map()
     print("=== Data saved ===")
     try:
         esm.vis_gp_heatmap()
     except Exception as e:
         print("Exception thrown visualizing the GP:\n", e)
+    esm.commit_scan()
     print("=== GP visualization complete ===")
 
     # run the experiment again -----------------------------------------------------------
@@ -272,10 +607,12 @@ if __name__ == "__main__":
     esm.rx_beamscan()
     esm.save_beamscan_data()
     esm.save_camera_image()
+    esm.save_angle_delay_map()
     try:
         esm.vis_gp_heatmap()
     except Exception as e:
         print("Exception thrown visualizing the GP:\n", e)
+    esm.commit_scan()
     print("=== 2nd Experiment complete ===")
     # shutdown the system -----------------------------------------------------------
     print("=== Shutting down the experiment system manager ===")
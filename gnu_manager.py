@@ -1,16 +1,42 @@
 # this script is used to manage GNU Radio processes using Python's subprocess module.
 # It provides a class GNURadioManager that can start, poll, and stop a GNU Radio process.
 # this is needed because gnuradio needs to run in a different conda environment 
+# the environment is activated once per (conda_root, conda_env) to resolve its interpreter and
+# variables, after that the flowgraph is exec'd directly (no shell) so signals reach it on stop()
 
 
+import json
+import os
 import subprocess
 import threading
 import time
+import xmlrpc.client
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    '''xmlrpc transport with a socket timeout, so a hung flowgraph cannot block the caller'''
+    def __init__(self, timeout:float, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
 
 class GNURadioManager:
     '''Class to manage GNU Radio processes using Python's subprocess module'''
-    def __init__(self, conda_env, path, python_filename, read_stdout=False, read_stderr=False, **kwargs):
+    # printed by the flowgraph (python snippet, main_after_start) once tb.start() returns
+    ready_line = "FLOWGRAPH READY"
+    stderr_tail_len = 20
+    # resolved {(conda_root, conda_env): (interpreter, environment variables)}, shared by all managers
+    _env_cache:dict[tuple[str, str], tuple[str, dict[str, str]]] = {}
+    # variables the flowgraph exposes setters for over its xmlrpc control channel
+    control_variables = ("freq", "tx_gain", "rx_gain", "encoding", "chan_est", "lo_offset", "samp_rate")
+    def __init__(self, conda_env, path, python_filename, read_stdout=False, read_stderr=False,
+                 conda_root="~/radioconda", control_address:str="127.0.0.1", control_port:int|None=None,
+                 control_timeout:float=2.0, **kwargs):
         self.conda_env = conda_env
+        self.conda_root = os.path.expanduser(conda_root)
         self.path = path
         self.python_filename = python_filename
         self.read_stdout = read_stdout
@@ -21,50 +47,149 @@ class GNURadioManager:
         self.stdout_thread = None
         self.stderr_thread = None
         self._stop_threads = threading.Event()
+        self._ready = threading.Event() # set when the flowgraph prints the ready_line
+        self.stderr_tail = [] # last few stderr lines, reported if the flowgraph dies during startup
+        # xmlrpc control channel (xmlrpc_server block in the flowgraph), None if the flowgraph has none
+        self.control_address = control_address
+        self.control_port = control_port
+        self.control_timeout = control_timeout
+        self._control:xmlrpc.client.ServerProxy|None = None
+
+    def resolve_environment(self, refresh:bool=False) -> tuple[str, dict[str, str]]:
+        '''activate the conda environment once and record its python interpreter and environment variables
+        the result is cached for the life of the python process, refresh=True forces a new activation'''
+        key = (self.conda_root, self.conda_env)
+        if not refresh and key in self._env_cache:
+            return self._env_cache[key]
+        probe = "import json, os, sys; print(json.dumps({'python': sys.executable, 'env': dict(os.environ)}))"
+        script = (
+            f'source "{self.conda_root}/etc/profile.d/conda.sh" && '
+            f'conda activate "{self.conda_env}" && '
+            f'python -c "{probe}"'
+        )
+        start_time = time.time()
+        result = subprocess.run(["bash", "-c", script], capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            raise RuntimeError(f"Failed to activate conda environment {self.conda_env}:\n{result.stderr}")
+        resolved = json.loads(result.stdout.strip().splitlines()[-1]) # activation scripts may print before
+        self._env_cache[key] = (resolved['python'], resolved['env'])
+        print(f"Resolved conda environment {self.conda_env} in {time.time() - start_time:.2f} seconds:",
+              resolved['python'])
+        return self._env_cache[key]
 
     def _build_command(self):
-        kwargs_string = ' '.join(f"--{key} {value}" for key, value in self.kwargs.items()) if self.kwargs else ''
-        full_command_string = f"{kwargs_string}".strip()
-        print("Command kwargs:", full_command_string)
-
-        command = (
-            f"bash -c 'source ~/radioconda/etc/profile.d/conda.sh && "
-            f"conda activate {self.conda_env} && "
-            f"cd {self.path} && "
-            f"python {self.python_filename} {full_command_string}'"
-        )
-        print("Command:\n", command)
+        '''build the argv list to exec the flowgraph with the environment's interpreter'''
+        python, _ = self.resolve_environment()
+        kwargs_args = [arg for key, value in self.kwargs.items() for arg in (f"--{key}", str(value))]
+        print("Command kwargs:", ' '.join(kwargs_args))
+
+        # -u: unbuffered output, so the ready line and the logs arrive as they are printed
+        command = [python, "-u", self.python_filename, *kwargs_args]
+        print("Command:\n", ' '.join(command))
         return command
 
-    def _read_output(self, pipe, pipe_name):
+    def _read_output(self, pipe, pipe_name, echo):
+        '''drain the pipe (so the flowgraph never blocks on a full pipe),
+        watch for the ready line and optionally echo each line'''
+        process = self.process
         while not self._stop_threads.is_set():
             line = pipe.readline()
             if line:
-                print(f"{pipe_name}: {line.strip()}")
-            elif self.process.poll() is not None:
+                line = line.strip()
+                if pipe_name == "STDOUT" and line == self.ready_line:
+                    self._ready.set()
+                if pipe_name == "STDERR":
+                    self.stderr_tail = (self.stderr_tail + [line])[-self.stderr_tail_len:]
+                if echo:
+                    print(f"{pipe_name}: {line}")
+            elif process.poll() is not None:
                 break
         pipe.close()
 
     def start(self):
-        command = self._build_command()
+        self._stop_threads.clear()
+        self._ready.clear()
+        self.stderr_tail = []
         try:
+            command = self._build_command()
+            _, env = self.resolve_environment()
             self.process = subprocess.Popen(
-                command, shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                command, cwd=self.path, env=env, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
             self.pid = self.process.pid
             print("Process started with PID:", self.process.pid)
 
-            # Start threads to read stdout and stderr if required
-            if self.read_stdout:
-                self.stdout_thread = threading.Thread(target=self._read_output, args=(self.process.stdout, "STDOUT"))
-                self.stdout_thread.start()
+            # Start threads to read stdout and stderr, they always drain the pipes
+            # (stdout carries the ready line) and echo them if required
+            self.stdout_thread = threading.Thread(target=self._read_output,
+                                                  args=(self.process.stdout, "STDOUT", self.read_stdout), daemon=True)
+            self.stdout_thread.start()
 
-            if self.read_stderr:
-                self.stderr_thread = threading.Thread(target=self._read_output, args=(self.process.stderr, "STDERR"))
-                self.stderr_thread.start()
+            self.stderr_thread = threading.Thread(target=self._read_output,
+                                                  args=(self.process.stderr, "STDERR", self.read_stderr), daemon=True)
+            self.stderr_thread.start()
         except Exception as e:
             print("Error occurred while starting subprocess:", e)
 
+    def wait_ready(self, timeout:float=30.0, interval:float=0.05) -> bool:
+        '''block until the flowgraph reports that it is running (ready_line on stdout)
+        returns True as soon as it is up, False if the process exits or the timeout expires'''
+        if self.process is None:
+            print("No process to wait for.")
+            return False
+        start_time = time.time()
+        while not self._ready.wait(interval):
+            return_code = self.process.poll() if self.process is not None else -1
+            if return_code is not None:
+                print("GNURadio Process exited before becoming ready, return code:", return_code)
+                if self.stderr_thread is not None:
+                    self.stderr_thread.join(timeout=1) # let the reader collect the last lines
+                for line in self.stderr_tail:
+                    print(f"STDERR: {line}")
+                return False
+            if time.time() - start_time > timeout:
+                print(f"GNURadio Process not ready after {timeout} seconds.")
+                return False
+        print(f"GNURadio Process ready after {time.time() - start_time:.2f} seconds.")
+        return True
+
+    def is_ready(self) -> bool:
+        '''True if the flowgraph has reported ready and is still running'''
+        return self._ready.is_set() and self.process is not None and self.process.poll() is None
+
+    def _get_control(self) -> xmlrpc.client.ServerProxy:
+        '''get (or create) the proxy to the flowgraph's xmlrpc server'''
+        if self.control_port is None:
+            raise RuntimeError("No control port configured for the GNU Radio process")
+        if self._control is None:
+            self._control = xmlrpc.client.ServerProxy(f"http://{self.control_address}:{self.control_port}",
+                                                      transport=_TimeoutTransport(self.control_timeout),
+                                                      allow_none=True)
+        return self._control
+
+    def set_variable(self, name:str, value):
+        '''call the flowgraph setter set_<name>(value) over the control channel
+        this retunes the running flowgraph without restarting it'''
+        if name not in self.control_variables:
+            raise ValueError(f"Unknown flowgraph variable: {name}, expected one of {self.control_variables}")
+        if isinstance(value, int) and abs(value) > 2**31 - 1: # xmlrpc ints are 32 bit (ex. freq in Hz)
+            value = float(value)
+        getattr(self._get_control(), f"set_{name}")(value)
+
+    def get_variable(self, name:str):
+        '''read the current value of a flowgraph variable over the control channel'''
+        if name not in self.control_variables:
+            raise ValueError(f"Unknown flowgraph variable: {name}, expected one of {self.control_variables}")
+        return getattr(self._get_control(), f"get_{name}")()
+
+    def set_variables(self, **variables):
+        '''set several flowgraph variables, ex. set_variables(tx_gain=0.6, rx_gain=0.4)
+        returns the time taken in seconds'''
+        start_time = time.time()
+        for name, value in variables.items():
+            self.set_variable(name, value)
+        return time.time() - start_time
+
     def poll(self):
         if self.process is None:
             print("No process to poll.")
@@ -93,6 +218,8 @@ class GNURadioManager:
         finally:
             self.process = None
             self.pid = None
+            self._ready.clear()
+            self._control = None
 
             # Wait for threads to finish if they were started
             if self.stdout_thread:
@@ -110,7 +237,8 @@ if __name__ == "__main__":
     manager = GNURadioManager(conda_env, path, python_filename, read_stdout=True, read_stderr=True)
     manager.start()
 
-    time.sleep(5)  # Wait for a while before polling
+    if not manager.wait_ready(timeout=30):  # returns as soon as the flowgraph is up
+        print("Flowgraph failed to start.")
 
     poll_limit = 20  # Poll for X seconds
 
@@ -1,11 +1,14 @@
 # this creates a Gaussian Process object to abstract the Gaussian Process regression model.
 
+import base64
+import io
+import json
 import pickle
 import plotly.graph_objects as go
 import plotly.express as px
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+from plotly.utils import PlotlyJSONEncoder
 import matplotlib.pyplot as plt
-from matplotlib.axes import Axes
-from matplotlib.figure import Figure
 import glob
 import os
 import time
@@ -18,10 +21,325 @@ from sklearn.gaussian_process.kernels import RBF, Matern, WhiteKernel, ConstantK
 from sklearn.gaussian_process.kernels import Kernel
 
 from scipy.stats import norm
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay, cKDTree
+from scipy.spatial.distance import cdist
+from sklearn.metrics import r2_score
+
+from artifact_writer import ArtifactWriter, write_atomic, write_image
+from csi_codec import load_csi_data
 
 import warnings
 warnings.filterwarnings("ignore") # ignore the warnings from the GP
 
+# 256 entry RGBA lookup table of the viridis colormap, the same colours imshow + savefig produce
+VIRIDIS_LUT:np.ndarray = plt.get_cmap('viridis')(np.arange(256), bytes=True)
+
+# the BBoxOne5G steers up to theta = 45 deg (see BBox5G.check_theta), radius sin(45 deg) in the x, y plane
+STEER_THETA_MAX:float = 45.0
+
+def cone_mask(aa:np.ndarray, theta_max:float=STEER_THETA_MAX) -> np.ndarray:
+    '''True for the (x, y) points inside the steerable cone x^2 + y^2 <= sin(theta_max)^2'''
+    radius = np.sin(np.deg2rad(theta_max))
+    return aa[:, 0]**2 + aa[:, 1]**2 <= radius**2 + 1e-12
+
+def render_heatmap(data:np.ndarray, vmin:float, vmax:float, lut:np.ndarray=VIRIDIS_LUT,
+                   origin:str='lower') -> np.ndarray:
+    '''map a 2d array through a 256 entry colormap lookup table, returns a uint8 RGBA image
+    this is pixel-equivalent to imshow(data, cmap, vmin, vmax, origin) saved 1:1 with savefig:
+    values are clamped to [vmin, vmax], NaN values are transparent'''
+    n_colors = len(lut)
+    scaled = (data - vmin) / (vmax - vmin) * n_colors # same operation order as Normalize + Colormap
+    nan_mask = np.isnan(scaled)
+    index = np.clip(np.floor(np.nan_to_num(scaled)), 0, n_colors - 1).astype(np.intp)
+    image = lut[index]
+    image[nan_mask] = 0 # 'bad' colour, fully transparent
+    if origin == 'lower': # row 0 is the bottom of the image
+        image = image[::-1]
+    return np.ascontiguousarray(image)
+
+def plotlyjs_asset(directory:str) -> str:
+    '''write the plotly.js bundle once into the directory, it is shared by every compact html file there
+    the filename carries the plotly.js version so an upgrade never mixes bundles
+    returns the path of the bundle'''
+    filename = os.path.join(directory, f"plotly-{get_plotlyjs_version()}.min.js")
+    if not os.path.exists(filename):
+        write_atomic(filename, get_plotlyjs().encode('utf-8'))
+    return filename
+
+def _encode_typed_arrays(obj, float32:bool=True):
+    '''replace the numeric arrays of a plotly figure dict with base64 typed arrays {dtype, bdata, shape}
+    (plotly.js >= 2.28), float arrays are stored as float32 if float32 is True'''
+    if isinstance(obj, dict):
+        if 'bdata' in obj and 'dtype' in obj: # already typed (plotly.py >= 6), re-encode as float32 if asked
+            array = np.frombuffer(base64.b64decode(obj['bdata']), dtype=obj['dtype'])
+            if 'shape' in obj:
+                array = array.reshape([int(n) for n in str(obj['shape']).split(',')])
+            return _encode_typed_arrays(array, float32)
+        return {key: _encode_typed_arrays(value, float32) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode_typed_arrays(value, float32) for value in obj]
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in 'fiu' and obj.size > 0:
+        if obj.dtype.kind == 'f':
+            array = obj.astype('<f4' if float32 else '<f8')
+        elif obj.dtype.itemsize > 4: # plotly.js has no 64 bit integer typed arrays
+            array = obj.astype('<f8')
+        else:
+            array = obj.astype(obj.dtype.newbyteorder('<'))
+        array = np.ascontiguousarray(array)
+        typed = {'dtype': array.dtype.str[1:], 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+        if array.ndim > 1:
+            typed['shape'] = ', '.join(str(n) for n in array.shape)
+        return typed
+    return obj
+
+def write_compact_html(figs:list[go.Figure], filename:str, title:str="",
+                       plotlyjs_dir:str|None=None, float32:bool=True):
+    '''write one or more plotly figures into a single html document
+    the document references a shared local plotly.js bundle (plotlyjs_dir, default: the html directory)
+    instead of embedding the ~3MB bundle, and the arrays are stored as base64 typed arrays'''
+    directory = os.path.dirname(os.path.abspath(filename))
+    bundle = plotlyjs_asset(directory if plotlyjs_dir is None else plotlyjs_dir)
+    typed = tuple(int(n) for n in get_plotlyjs_version().split('.')[:2]) >= (2, 28)
+    divs = []; scripts = []
+    for ii, fig in enumerate(figs):
+        spec = fig.to_plotly_json()
+        data = _encode_typed_arrays(spec['data'], float32) if typed else spec['data']
+        layout = spec.get('layout', {})
+        divs.append(f'<div id="plot{ii}" style="width:100%;height:600px;"></div>')
+        scripts.append(f'Plotly.newPlot("plot{ii}", {json.dumps(data, cls=PlotlyJSONEncoder)}, '
+                       f'{json.dumps(layout, cls=PlotlyJSONEncoder)}, {{"responsive": true}});')
+    newline = '\n'
+    html = (f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n'
+            f'<script src="{os.path.relpath(bundle, directory)}"></script>\n</head>\n<body>\n'
+            f'{newline.join(divs)}\n<script>\n{newline.join(scripts)}\n</script>\n</body>\n</html>\n')
+    write_atomic(filename, html.encode('utf-8'))
+
+# ------------------------------------------ COMPACT MODEL ------------------------------------------
+
+def kernel_spec(kernel:Kernel) -> dict:
+    '''describe a (fitted) ConstantKernel * RBF|Matern + WhiteKernel kernel with plain numbers
+    this is the kernel family used by GaussianProcess, other kernels raise a ValueError'''
+    try:
+        product, white = kernel.k1, kernel.k2
+        constant, base = product.k1, product.k2
+    except AttributeError:
+        raise ValueError(f"Unsupported kernel (expected C * RBF|Matern + WhiteKernel): {kernel}")
+    if not isinstance(constant, C) or not isinstance(white, WhiteKernel):
+        raise ValueError(f"Unsupported kernel (expected C * RBF|Matern + WhiteKernel): {kernel}")
+    spec = {'constant_value': float(constant.constant_value),
+            'length_scale': np.atleast_1d(base.length_scale).astype(float).tolist(),
+            'noise_level': float(white.noise_level)}
+    if isinstance(base, Matern): # Matern is a subclass of RBF, check it first
+        if base.nu not in (0.5, 1.5, 2.5, np.inf):
+            raise ValueError(f"Unsupported Matern nu: {base.nu}, expected 0.5, 1.5, 2.5 or inf")
+        spec['type'] = 'rbf' if base.nu == np.inf else 'matern'
+        spec['nu'] = float(base.nu)
+    elif isinstance(base, RBF):
+        spec['type'] = 'rbf'
+    else:
+        raise ValueError(f"Unsupported kernel (expected C * RBF|Matern + WhiteKernel): {kernel}")
+    return spec
+
+def kernel_matrix(spec:dict, X:np.ndarray, Y:np.ndarray|None=None) -> np.ndarray:
+    '''evaluate a kernel_spec between X and Y (X and X if Y is None), the white noise term is not included
+    (as sklearn does for the cross covariance)'''
+    length_scale = np.asarray(spec['length_scale'])
+    Y = X if Y is None else Y
+    if spec['type'] == 'rbf':
+        K = np.exp(-0.5 * cdist(X / length_scale, Y / length_scale, metric='sqeuclidean'))
+    else:
+        dist = cdist(X / length_scale, Y / length_scale, metric='euclidean')
+        if spec['nu'] == 0.5:
+            K = np.exp(-dist)
+        elif spec['nu'] == 1.5:
+            K = dist * np.sqrt(3)
+            K = (1.0 + K) * np.exp(-K)
+        else: # nu == 2.5
+            K = dist * np.sqrt(5)
+            K = (1.0 + K + K**2 / 3.0) * np.exp(-K)
+    return spec['constant_value'] * K
+
+def kernel_diag(spec:dict, X:np.ndarray) -> np.ndarray:
+    '''the prior variance of a kernel_spec at the points X (including the white noise term)'''
+    return np.full(len(X), spec['constant_value'] + spec['noise_level'])
+
+
+class GPModel():
+    '''Compact fitted Gaussian Process predictor, it only needs numpy/scipy to predict
+    stores the fitted kernel hyperparameters, the training inputs/targets, the dual coefficients (alpha)
+    and optionally the Cholesky factor of the training covariance (needed for the std)
+    plus the prediction grid spec (not the grid itself)
+    for the sparse backend X_train are the inducing points, y_train is None and the std uses var_matrix'''
+    def __init__(self, kernel:dict, X_train:np.ndarray, y_train:np.ndarray|None, alpha:np.ndarray,
+                 L:np.ndarray|None=None, grid:dict|None=None, meta:dict|None=None,
+                 var_matrix:np.ndarray|None=None):
+        self.kernel = kernel # kernel_spec
+        self.X_train = X_train; self.y_train = y_train
+        self.alpha = alpha # K^-1 y
+        self.L = L # lower Cholesky factor of the training covariance (K + noise)
+        self.var_matrix = var_matrix # sparse backend: var = k** - k*u var_matrix ku*
+        self.grid = grid # {'xx_range', 'yy_range', 'resolution'} as used by GaussianProcess.create_linespace
+        self.meta = {} if meta is None else meta # extra info, ex. plot_z_min/plot_z_max
+
+    def predict(self, X:np.ndarray, return_std:bool=False):
+        '''predict the mean (and std) at the points X, same results as GaussianProcessRegressor.predict'''
+        K_trans = kernel_matrix(self.kernel, X, self.X_train)
+        y_mean = K_trans @ self.alpha
+        if not return_std:
+            return y_mean
+        if self.L is not None:
+            V = solve_triangular(self.L, K_trans.T, lower=True, check_finite=False)
+            y_var = kernel_diag(self.kernel, X) - np.einsum("ij,ij->j", V, V)
+        elif self.var_matrix is not None:
+            y_var = kernel_diag(self.kernel, X) - np.einsum("ij,ij->i", K_trans @ self.var_matrix, K_trans)
+        else:
+            raise ValueError("The model was saved without the Cholesky factor, the std is not available")
+        y_var[y_var < 0] = 0 # numerical noise
+        return y_mean, np.sqrt(y_var)
+
+    def grid_points(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''rebuild the (xx, yy, aa) prediction grid from the grid spec'''
+        if self.grid is None:
+            raise ValueError("The model was saved without a grid spec")
+        xx = np.linspace(self.grid['xx_range'][0], self.grid['xx_range'][1], self.grid['resolution'])
+        yy = np.linspace(self.grid['yy_range'][0], self.grid['yy_range'][1], self.grid['resolution'])
+        aa = np.array(list(product(xx, yy)))
+        return xx, yy, aa
+
+    def predict_grid(self, return_std:bool=True, full:bool=False):
+        '''predict over the grid of the grid spec (as GaussianProcess.fit does)
+        with a 'theta_max' in the grid spec only the points inside the cone are predicted, the others are NaN
+        full: predict every grid point, also outside the cone (no NaN)'''
+        _, _, aa = self.grid_points()
+        if full or self.grid.get('theta_max') is None:
+            return self.predict(aa, return_std=return_std)
+        mask = cone_mask(aa, self.grid['theta_max'])
+        results = self.predict(aa[mask], return_std=return_std)
+        results = results if return_std else (results,)
+        filled = []
+        for result in results:
+            full = np.full(len(aa), np.nan)
+            full[mask] = result
+            filled.append(full)
+        return tuple(filled) if return_std else filled[0]
+
+    def save(self, filename:str):
+        '''save the model as a compressed .npz (numpy arrays + a json header, no pickle)'''
+        header = {'format': 'gp_model', 'version': 1, 'kernel': self.kernel, 'grid': self.grid, 'meta': self.meta}
+        arrays = {'X_train': self.X_train, 'alpha': self.alpha}
+        for name in ('y_train', 'L', 'var_matrix'): # optional arrays
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        buffer = io.BytesIO() # a file object so numpy does not append .npz to the filename
+        np.savez_compressed(buffer, header=np.array(json.dumps(header)), **arrays)
+        write_atomic(filename, buffer.getvalue()) # replaces (never rewrites) an existing file, see artifact_store
+        print(f"GP model saved to {filename}")
+
+    @classmethod
+    def load(cls, filename:str) -> 'GPModel':
+        '''load a model saved with GPModel.save'''
+        with np.load(filename, allow_pickle=False) as npz:
+            header = json.loads(str(npz['header']))
+            if header.get('format') != 'gp_model':
+                raise ValueError(f"{filename} is not a GP model file")
+            optional = {name: npz[name] if name in npz.files else None for name in ('y_train', 'L', 'var_matrix')}
+            return cls(kernel=header['kernel'], X_train=npz['X_train'], alpha=npz['alpha'],
+                       grid=header['grid'], meta=header['meta'], **optional)
+
+def load_model(filename:str) -> GPModel:
+    '''load a compact GP model (see GaussianProcess.save_model)'''
+    return GPModel.load(filename)
+
+# ------------------------------------------ SPARSE BACKEND ------------------------------------------
+
+class SparseGaussianProcessRegressor():
+    '''Inducing point (DTC / projected process) Gaussian Process regressor for dense or long-dwell scans
+    fit is O(n m^2) for n packets and m inducing points instead of the exact O(n^3)
+    implements the GaussianProcessRegressor calls GaussianProcess makes (fit, predict, score, kernel_)
+    the hyperparameters are optimized by an exact GaussianProcessRegressor on a random subset of at most
+    max_exact points (optimizer=None keeps the given kernel), then kept fixed for the sparse fit
+    the inducing points are a regular grid over the (x,y) extent of the data, keeping only the points
+    near the data (the steerable disk)'''
+    def __init__(self, kernel:Kernel, n_inducing:int=400, max_exact:int=500,
+                 optimizer:str|None='fmin_l_bfgs_b', n_restarts_optimizer:int=5,
+                 alpha:float|np.ndarray=1e-10, random_state:int=42):
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.max_exact = max_exact
+        self.optimizer = optimizer
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.alpha = alpha # extra noise added to the diagonal, scalar or per training point
+        self.random_state = random_state
+
+    def set_params(self, **params):
+        '''set parameters (like sklearn estimators)'''
+        for key, value in params.items():
+            setattr(self, key, value)
+        return self
+
+    def _inducing_points(self, X:np.ndarray) -> np.ndarray:
+        '''regular grid of about n_inducing points over the extent of X, without the points far from X'''
+        side = int(np.ceil(np.sqrt(self.n_inducing)))
+        xx = np.linspace(X[:,0].min(), X[:,0].max(), side)
+        yy = np.linspace(X[:,1].min(), X[:,1].max(), side)
+        Z = np.array(list(product(xx, yy)))
+        spacing = max(xx[1] - xx[0], yy[1] - yy[0]) if side > 1 else np.inf
+        distance, _ = cKDTree(X).query(Z)
+        return Z[distance <= spacing]
+
+    def fit(self, X:np.ndarray, y:np.ndarray):
+        '''optimize the hyperparameters on a subset, then fit the sparse posterior on all the points'''
+        if self.optimizer is not None:
+            rng = np.random.default_rng(self.random_state)
+            subset = rng.choice(len(X), size=min(len(X), self.max_exact), replace=False)
+            alpha = self.alpha[subset] if np.ndim(self.alpha) else self.alpha
+            exact = GaussianProcessRegressor(kernel=self.kernel, optimizer=self.optimizer,
+                                             n_restarts_optimizer=self.n_restarts_optimizer,
+                                             alpha=alpha, random_state=self.random_state)
+            exact.fit(X[subset], y[subset])
+            self.kernel_ = exact.kernel_
+        else:
+            self.kernel_ = self.kernel
+        self.spec_ = kernel_spec(self.kernel_)
+        self.X_train_ = X; self.y_train_ = y
+        self.Z_ = self._inducing_points(X)
+        noise = self.spec_['noise_level'] + np.broadcast_to(self.alpha, (len(X),)) # per point noise variance
+
+        Kuu = kernel_matrix(self.spec_, self.Z_)
+        Kuu[np.diag_indices_from(Kuu)] += 1e-8 * self.spec_['constant_value'] # jitter
+        Kuf = kernel_matrix(self.spec_, self.Z_, X)
+        self.Luu_ = cholesky(Kuu, lower=True)
+        V = solve_triangular(self.Luu_, Kuf, lower=True) # m x n
+        B = np.eye(len(self.Z_)) + (V / noise) @ V.T # Luu^-1 (Kuu + Kuf N^-1 Kfu) Luu^-T
+        self.LB_ = cholesky(B, lower=True)
+        c = solve_triangular(self.LB_, V @ (y / noise), lower=True)
+        self.alpha_ = solve_triangular(self.Luu_.T, solve_triangular(self.LB_.T, c, lower=False), lower=False)
+        return self
+
+    def predict(self, X:np.ndarray, return_std:bool=False):
+        '''predict the mean (and std, including the white noise like the exact backend) at the points X'''
+        Ksu = kernel_matrix(self.spec_, X, self.Z_)
+        y_mean = Ksu @ self.alpha_
+        if not return_std:
+            return y_mean
+        W1 = solve_triangular(self.Luu_, Ksu.T, lower=True)
+        W2 = solve_triangular(self.LB_, W1, lower=True)
+        y_var = kernel_diag(self.spec_, X) - np.einsum("ij,ij->j", W1, W1) + np.einsum("ij,ij->j", W2, W2)
+        y_var[y_var < 0] = 0 # numerical noise
+        return y_mean, np.sqrt(y_var)
+
+    def score(self, X:np.ndarray, y:np.ndarray) -> float:
+        '''coefficient of determination (R^2) of the mean prediction'''
+        return r2_score(y, self.predict(X))
+
+    def var_matrix(self) -> np.ndarray:
+        '''Kuu^-1 - A^-1, the predictive variance is k** - k*u var_matrix ku* (used by GPModel)'''
+        identity = np.eye(len(self.Z_))
+        Luu_inv = solve_triangular(self.Luu_, identity, lower=True)
+        B_inv = cho_solve((self.LB_, True), identity)
+        return Luu_inv.T @ (identity - B_inv) @ Luu_inv
 
 
 class GaussianProcess():
@@ -86,25 +404,67 @@ class GaussianProcess():
                 print(f"CSI Magnitude Range: {csi_min} - {csi_max}")
             return theta_phi, csi_mag
     
-    def __init__(self, data: list[dict], linespace_density:int=180,
-                 kernel:Kernel|None = None):
+    def aggregate_beams(self, theta_phi:np.ndarray, csi_mag:np.ndarray):
+        '''collapse the packets of each beam (same x,y) into one training point
+        returns the unique theta_phi, the mean magnitude per beam, the variance of that mean
+        (empirical variance / packets, 0 for single packet beams) and the number of packets per beam'''
+        beams, inverse, counts = np.unique(theta_phi, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        mean = np.bincount(inverse, weights=csi_mag) / counts
+        squares = np.bincount(inverse, weights=(csi_mag - mean[inverse])**2)
+        variance = np.divide(squares, counts - 1, out=np.zeros_like(mean), where=counts > 1) # unbiased
+        return beams, mean, variance / counts, counts
+
+    def __init__(self, data: list[dict]|str, linespace_density:int=180,
+                 kernel:Kernel|None = None, backend:str='exact', n_inducing:int=400,
+                 aggregate:bool=True, mask_cone:bool=False):
         '''initialize the Gaussian Process object
+        data: the beamscan csi data, or the filename of a saved scan (pickle or csi archive, see load_csi_data)
+        backend: 'exact' sklearn GaussianProcessRegressor (O(n^3)),
+            'sparse' SparseGaussianProcessRegressor with about n_inducing inducing points (O(n m^2))
+        aggregate: fit one point per beam (mean of its packets) with the variance of the mean
+            as per point noise (alpha), instead of one point per packet
+        mask_cone: predict only inside the steerable cone (theta <= STEER_THETA_MAX), the grid points
+            outside are NaN (transparent in the png), ~21% less prediction work
         WARNING: THIS HAS LOTS OF HARDCODED VALUES!'''
         # extract the data
+        if isinstance(data, str):
+            data = load_csi_data(data)
         self.theta_phi, self.csi_mag = self.extract_plot_data(data)
+        self.n_packets = len(self.csi_mag)
+        self.alpha:np.ndarray|float = 1e-10 # sklearn default, added to the diagonal of the training covariance
+        if aggregate:
+            self.theta_phi, self.csi_mag, mean_variance, self.packet_counts = self.aggregate_beams(self.theta_phi,
+                                                                                                    self.csi_mag)
+            self.alpha = 1e-10 + mean_variance
+            print(f"Packets aggregated per beam, Num_Beams: {len(self.csi_mag)}")
         # create the Gaussian Process object
         if kernel is None:
             self.kernel = C(0.0224**2) * RBF(length_scale=0.179) + WhiteKernel(2.79e-05)
             print("Using Default Kernel")
         else:
             self.kernel = kernel
-        self.gp = GaussianProcessRegressor( kernel=self.kernel,
-                                    optimizer='fmin_l_bfgs_b',
-                                    n_restarts_optimizer=30,
-                                    copy_X_train=True,
-                                    random_state=42)
+        self.backend = backend
+        if backend == 'exact':
+            self.gp = GaussianProcessRegressor( kernel=self.kernel,
+                                        alpha=self.alpha,
+                                        optimizer='fmin_l_bfgs_b',
+                                        n_restarts_optimizer=30,
+                                        copy_X_train=True,
+                                        random_state=42)
+        elif backend == 'sparse':
+            self.gp = SparseGaussianProcessRegressor(kernel=self.kernel,
+                                                     n_inducing=n_inducing,
+                                                     alpha=self.alpha,
+                                                     optimizer='fmin_l_bfgs_b',
+                                                     n_restarts_optimizer=5,
+                                                     random_state=42)
+        else:
+            raise ValueError("backend must be 'exact' or 'sparse'")
         
         self.linespace_density = linespace_density
+        self.grid_range:tuple[float, float] = (-0.7, 0.7) # experimentally determined values, x and y
+        self.theta_max:float|None = STEER_THETA_MAX if mask_cone else None # predict inside this cone only
 
         # plotting variables
         self.plot_z_max:float = 0.127 # experimentally determined values
@@ -119,40 +479,66 @@ class GaussianProcess():
         print(f"Model Score: {self.self_score}")
         # create the meshgrid for the prediction
         
-        xx, yy, aa = self.create_linespace(xx_range=(-0.7,0.7), # experimentally determined values
-                                           yy_range=(-0.7,0.7), 
+        xx, yy, aa = self.create_linespace(xx_range=self.grid_range,
+                                           yy_range=self.grid_range,
                                            resolution=self.linespace_density)
         self.xx = xx; self.yy = yy; self.aa = aa # save the meshgrid with the object
 
-        yy_pred, yy_std = self.gp.predict(aa, return_std=True)
+        if self.theta_max is None:
+            yy_pred, yy_std = self.gp.predict(aa, return_std=True)
+        else: # the points outside the steerable cone are not predicted
+            mask = cone_mask(aa, self.theta_max)
+            yy_pred = np.full(len(aa), np.nan); yy_std = np.full(len(aa), np.nan)
+            yy_pred[mask], yy_std[mask] = self.gp.predict(aa[mask], return_std=True)
         self.yy_pred = yy_pred; self.yy_std = yy_std # save the prediction and std with the object
     
-    def save_image(self, data:np.ndarray, filename:str, dpi:int=100):
+    def save_image(self, data:np.ndarray, filename:str, dpi:int=100, writer:ArtifactWriter|None=None):
         '''plot/save the an output image files as a heatmap png
         dpi=100, linespace_density=180 gives a 180x180 pixel image
-        z_min and z_max are the min and max values for the colorbar
-        the data should be directly from the prediction (this function reshapes the data)'''
+        z_min and z_max are the min and max values for the colorbar (values outside are clamped)
+        the data should be directly from the prediction (this function reshapes the data)
+        if a writer is given the png is encoded and written off-thread (see writer.wait())'''
         # scan the data for any values outside the plot_z_min and plot_z_max, give a warning if found
-        if np.min(data) < self.plot_z_min:
+        # (NaN values are outside the steerable cone, they are transparent)
+        if np.nanmin(data) < self.plot_z_min:
             print(f"Warning: Predicted data contains values below the plot_z_min ({self.plot_z_min}).\
-                  MIN: {np.min(data)}")
-        if np.max(data) > self.plot_z_max:
+                  MIN: {np.nanmin(data)}")
+        if np.nanmax(data) > self.plot_z_max:
             print(f"Warning: Predicted data contains values above the plot_z_max ({self.plot_z_max}).\
-                  MAX: {np.max(data)}")
+                  MAX: {np.nanmax(data)}")
 
         # reshape the data
         data = data.reshape((self.linespace_density, self.linespace_density))
-        fig:Figure; ax:Axes # type hinting
-        fig, ax = plt.subplots(figsize=(self.linespace_density/100, self.linespace_density/100), dpi=dpi)
-        ax.axis('off')
-        # leave colorbar as automatic scaling
-        # ax.imshow(data, cmap='viridis', origin='lower')
-        # manually scale the colorbar
-        ax.imshow(data, cmap='viridis', origin='lower', vmin=self.plot_z_min, vmax=self.plot_z_max)
-        ax.set_aspect('equal')
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-        fig.savefig(filename, dpi=dpi)
-        print(f"plot saved to {filename}")
+        # map through the colormap lookup table, no matplotlib figure is created
+        image = render_heatmap(data, vmin=self.plot_z_min, vmax=self.plot_z_max)
+        size = round(self.linespace_density * dpi / 100)
+        if size != self.linespace_density: # other dpi values scale the image (nearest neighbour)
+            index = np.arange(size) * self.linespace_density // size
+            image = image[index][:, index]
+        if writer is not None:
+            writer.submit_image(image, filename, rgb=True)
+        else:
+            write_image(image, filename, rgb=True)
+            print(f"plot saved to {filename}")
+
+    def to_model(self, include_cholesky:bool=True) -> GPModel:
+        '''extract the compact predictor (GPModel) of the fitted model'''
+        grid = {'xx_range': list(self.grid_range), 'yy_range': list(self.grid_range),
+                'resolution': self.linespace_density, 'theta_max': self.theta_max}
+        meta = {'plot_z_min': self.plot_z_min, 'plot_z_max': self.plot_z_max, 'backend': self.backend}
+        if self.backend == 'sparse': # the inducing points are the basis of the prediction
+            return GPModel(kernel=self.gp.spec_, X_train=self.gp.Z_, y_train=None, alpha=self.gp.alpha_,
+                           var_matrix=self.gp.var_matrix() if include_cholesky else None,
+                           grid=grid, meta=meta)
+        return GPModel(kernel=kernel_spec(self.gp.kernel_),
+                       X_train=self.gp.X_train_, y_train=self.gp.y_train_, alpha=self.gp.alpha_,
+                       L=self.gp.L_ if include_cholesky else None,
+                       grid=grid, meta=meta)
+
+    def save_model(self, filename:str, include_cholesky:bool=True):
+        '''save the fitted model in the compact format (see GPModel), load it with load_model
+        without the Cholesky factor the file is smaller but the loaded model can only predict the mean'''
+        self.to_model(include_cholesky=include_cholesky).save(filename)
 
     def save_pickle(self, filename:str):
         '''save the Gaussian Process object to a pickle file'''
@@ -163,9 +549,10 @@ class GaussianProcess():
     # --------------------------------- EXTRA VISUALIZATION FUNCTIONS -------------------------------
     
     def plot_scatter(self, title="Scatter Plot",
-                    filename=None, show=False):
+                    filename=None, show=False, compact:bool=False):
         '''plot data as a plotly scatter plot
-        This does NOT use the plot_z_max and plot_z_min variables!'''
+        This does NOT use the plot_z_max and plot_z_min variables!
+        compact=True writes the html with write_compact_html (shared plotly.js, typed arrays)'''
         fig = px.scatter(x=self.theta_phi[:,0], y=self.theta_phi[:,1],
                          color=self.csi_mag,
                          labels={'color':'Magnitude'})
@@ -176,15 +563,20 @@ class GaussianProcess():
                         xaxis=dict(scaleanchor="y", scaleratio=1), # make the x and y axis the same scale
                         yaxis=dict(scaleanchor="x", scaleratio=1))
         if filename is not None:
-            fig.write_html(filename)
+            if compact:
+                write_compact_html([fig], filename, title=title)
+            else:
+                fig.write_html(filename)
             print(f"plot saved to {filename}")
         if show:
             fig.show()
+        return fig
     
     def plot_heatmap_gp(self, title="GP Prediction of Beamscan",
-                        filename=None, show=False):
+                        filename=None, show=False, compact:bool=False):
         '''plot the heatmap of the GP prediction
-        DATA IS AUTO-SCALED!'''
+        DATA IS AUTO-SCALED!
+        compact=True writes the html with write_compact_html (shared plotly.js, typed arrays)'''
         yy_pred_reshaped = self.yy_pred.reshape((self.linespace_density, self.linespace_density))
         fig = px.imshow(yy_pred_reshaped, x=self.xx, y=self.yy, color_continuous_scale='Viridis', origin='lower', labels={'color':'Magnitude'})
         fig.update_layout(title=title,
@@ -192,15 +584,20 @@ class GaussianProcess():
                         xaxis_title='X',
                         yaxis_title='Y')
         if filename is not None:
-            fig.write_html(filename)
+            if compact:
+                write_compact_html([fig], filename, title=title)
+            else:
+                fig.write_html(filename)
             print(f"plot saved to {filename}")
         if show:
             fig.show()
+        return fig
     
     def plot_heatmap_gp_std(self, title="GP Prediction of Beamscan error",
-                        filename=None, show=False):
+                        filename=None, show=False, compact:bool=False):
         '''plot the heatmap of the GP prediction
-        DATA IS AUTO-SCALED!'''
+        DATA IS AUTO-SCALED!
+        compact=True writes the html with write_compact_html (shared plotly.js, typed arrays)'''
         yy_std_reshaped = self.yy_std.reshape((self.linespace_density, self.linespace_density))
         fig = px.imshow(yy_std_reshaped, x=self.xx, y=self.yy, color_continuous_scale='Viridis', origin='lower', labels={'color':'Magnitude'})
         fig.update_layout(title=title,
@@ -208,11 +605,204 @@ class GaussianProcess():
                         xaxis_title='X',
                         yaxis_title='Y')
         if filename is not None:
-            fig.write_html(filename)
+            if compact:
+                write_compact_html([fig], filename, title=title)
+            else:
+                fig.write_html(filename)
             print(f"plot saved to {filename}")
         if show:
             fig.show()
-    
+        return fig
+
+    def plot_report(self, filename:str, title:str="Beamscan", plotlyjs_dir:str|None=None):
+        '''write the scatter, GP prediction and GP error plots into one compact html document
+        (shared plotly.js bundle, typed arrays), see write_compact_html'''
+        figs = [self.plot_scatter(), self.plot_heatmap_gp(), self.plot_heatmap_gp_std()]
+        write_compact_html(figs, filename, title=title, plotlyjs_dir=plotlyjs_dir)
+        print(f"plot saved to {filename}")
+
+
+class OnlineGaussianProcess(GaussianProcess):
+    '''Gaussian Process with fixed hyperparameters that is updated one beam at a time during a scan
+    each new training point extends the Cholesky factor by one row (rank-one update) and updates the
+    mean/variance over the grid in O(n * grid) instead of refitting in O(n^3 + n^2 * grid)
+    the current mean/std is available at any time (current()), the save/plot functions of GaussianProcess work
+    on the current state, the hyperparameters are not optimized (use GaussianProcess for that)
+    memory: the (n, grid) rows of L^-1 K(X, grid) are kept, ~85 MB for 326 beams on the 180x180 grid
+    (~67 MB with mask_cone, only the points inside the steerable cone are tracked)'''
+    def __init__(self, kernel:Kernel|None = None, linespace_density:int=180, mask_cone:bool=False):
+        if kernel is None:
+            kernel = C(0.0224**2) * RBF(length_scale=0.179) + WhiteKernel(2.79e-05) # the GaussianProcess default
+        self.kernel = kernel
+        self.spec = kernel_spec(kernel)
+        self.backend = 'online'
+        self.linespace_density = linespace_density
+        self.grid_range:tuple[float, float] = (-0.7, 0.7) # same grid as GaussianProcess
+        self.theta_max:float|None = STEER_THETA_MAX if mask_cone else None
+        self.plot_z_max:float = 0.127
+        self.plot_z_min:float = 0
+        self.xx, self.yy, self.aa = self.create_linespace(xx_range=self.grid_range, yy_range=self.grid_range,
+                                                          resolution=self.linespace_density)
+        self._mask = None if self.theta_max is None else cone_mask(self.aa, self.theta_max)
+        self._grid = self.aa if self._mask is None else self.aa[self._mask] # the tracked grid points
+
+        self.n = 0 # number of training points
+        capacity = 64 # grown by doubling
+        self._X = np.empty((capacity, 2)); self._y = np.empty(capacity); self._alpha = np.empty(capacity)
+        self._L = np.zeros((capacity, capacity)) # lower Cholesky factor of K(X, X) + diag(alpha)
+        self._V = np.empty((capacity, len(self._grid))) # L^-1 K(X, grid)
+        self._z = np.empty(capacity) # L^-1 y
+        self._mean = np.zeros(len(self._grid)) # prior mean 0 (as GaussianProcessRegressor)
+        self._var = kernel_diag(self.spec, self._grid).copy() # prior variance
+        self.packet_counts:list[int] = []
+
+    def _grow(self):
+        '''double the capacity of the training arrays'''
+        capacity = 2 * len(self._y)
+        self._X = np.resize(self._X, (capacity, 2)); self._y = np.resize(self._y, capacity)
+        self._alpha = np.resize(self._alpha, capacity); self._z = np.resize(self._z, capacity)
+        L = np.zeros((capacity, capacity)); L[:self.n, :self.n] = self._L[:self.n, :self.n]; self._L = L
+        V = np.empty((capacity, self._V.shape[1])); V[:self.n] = self._V[:self.n]; self._V = V
 
+    def add_point(self, xy:np.ndarray, value:float, noise:float=1e-10) -> bool:
+        '''add one training point (x, y) with its value and noise variance (alpha)
+        returns False if the point is numerically a duplicate and was skipped'''
+        xy = np.asarray(xy, dtype=np.float64).reshape(1, 2)
+        n = self.n
+        k = kernel_matrix(self.spec, self._X[:n], xy)[:, 0] # covariance with the previous points
+        l = solve_triangular(self._L[:n, :n], k, lower=True, check_finite=False) if n else k
+        d2 = kernel_diag(self.spec, xy)[0] + noise - l @ l
+        if d2 <= 1e-12:
+            print(f"Warning: point {xy[0]} is a numerical duplicate, skipped")
+            return False
+        d = np.sqrt(d2)
+        if n == len(self._y):
+            self._grow()
+        # new row of the Cholesky factor, of L^-1 K(X, grid) and of L^-1 y
+        self._L[n, :n] = l; self._L[n, n] = d
+        v = (kernel_matrix(self.spec, xy, self._grid)[0] - l @ self._V[:n]) / d
+        self._V[n] = v
+        z = (value - l @ self._z[:n]) / d
+        self._z[n] = z
+        self._X[n] = xy[0]; self._y[n] = value; self._alpha[n] = noise
+        self.n = n + 1
+        # mean = V^T z and var = k** - sum(V^2) gain one term each
+        self._mean += z * v
+        self._var -= v * v
+        return True
 
-    
\ No newline at end of file
+    def add_beam(self, theta:float, phi:float, values:np.ndarray|list[float]) -> bool:
+        '''add the packets of a beam (CSI magnitudes) as one point: their mean with the variance of the mean
+        as noise, like GaussianProcess(aggregate=True)'''
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return False
+        x, y, _ = self.convert_to_cartesian(theta, phi)
+        variance = values.var(ddof=1) / len(values) if len(values) > 1 else 0.0
+        added = self.add_point((x, y), values.mean(), noise=1e-10 + variance)
+        if added:
+            self.packet_counts.append(len(values))
+        return added
+
+    def add_packets(self, entries:list[dict]) -> bool:
+        '''add the packets of one beam as saved by rx_beamscan (lost packets are ignored)'''
+        values = [np.abs(entry['avg_csi']) for entry in entries if entry['avg_csi'] is not None]
+        if not values:
+            return False
+        return self.add_beam(entries[0]['beam']['theta'], entries[0]['beam']['phi'], values)
+
+    @property
+    def theta_phi(self) -> np.ndarray:
+        return self._X[:self.n]
+
+    @property
+    def csi_mag(self) -> np.ndarray:
+        return self._y[:self.n]
+
+    def current(self) -> tuple[np.ndarray, np.ndarray]:
+        '''the current (mean, std) over the grid, also stored as yy_pred/yy_std for the save/plot functions
+        with mask_cone the points outside the steerable cone are NaN'''
+        std = np.sqrt(np.maximum(self._var, 0)) # numerical noise
+        if self._mask is None:
+            self.yy_pred = self._mean.copy(); self.yy_std = std
+        else:
+            self.yy_pred = np.full(len(self.aa), np.nan); self.yy_std = np.full(len(self.aa), np.nan)
+            self.yy_pred[self._mask] = self._mean; self.yy_std[self._mask] = std
+        return self.yy_pred, self.yy_std
+
+    def fit(self):
+        '''nothing to fit (the hyperparameters are fixed), refresh yy_pred/yy_std'''
+        self.current()
+
+    def to_model(self, include_cholesky:bool=True) -> GPModel:
+        '''extract the compact predictor (GPModel) of the current state'''
+        n = self.n
+        L = self._L[:n, :n]
+        grid = {'xx_range': list(self.grid_range), 'yy_range': list(self.grid_range),
+                'resolution': self.linespace_density, 'theta_max': self.theta_max}
+        meta = {'plot_z_min': self.plot_z_min, 'plot_z_max': self.plot_z_max, 'backend': self.backend}
+        return GPModel(kernel=self.spec, X_train=self._X[:n].copy(), y_train=self._y[:n].copy(),
+                       alpha=cho_solve((L, True), self._y[:n]), L=L.copy() if include_cholesky else None,
+                       grid=grid, meta=meta)
+
+
+class InterpolationPreview(GaussianProcess):
+    '''Fast preview heatmap for operator feedback: linear interpolation of the beam magnitudes
+    on a Delaunay triangulation of the beam positions (no GP, no std)
+    the beam layout of the raster is the same scan after scan, so the interpolation weights are computed once
+    per layout and cached as a sparse (grid, beams) matrix, a preview is then one sparse matrix-vector product
+    the grid points outside the convex hull of the beams (and outside the cone with mask_cone) are NaN'''
+    def __init__(self, linespace_density:int=180, mask_cone:bool=True, cache_size:int=8):
+        self.linespace_density = linespace_density
+        self.grid_range:tuple[float, float] = (-0.7, 0.7) # same grid as GaussianProcess
+        self.theta_max:float|None = STEER_THETA_MAX if mask_cone else None
+        self.plot_z_max:float = 0.127
+        self.plot_z_min:float = 0
+        self.xx, self.yy, self.aa = self.create_linespace(xx_range=self.grid_range, yy_range=self.grid_range,
+                                                          resolution=self.linespace_density)
+        self._mask = None if self.theta_max is None else cone_mask(self.aa, self.theta_max)
+        self.cache_size = cache_size
+        self._cache:dict[bytes, tuple[csr_matrix, np.ndarray]] = {} # layout -> (weights, outside mask)
+
+    def weights(self, beams:np.ndarray) -> tuple[csr_matrix, np.ndarray]:
+        '''the (grid, beams) barycentric interpolation weights of a beam layout and the mask of the grid
+        points without a value, cached by layout'''
+        key = beams.tobytes()
+        if key in self._cache:
+            return self._cache[key]
+        tri = Delaunay(beams)
+        simplex = tri.find_simplex(self.aa)
+        inside = np.flatnonzero(simplex >= 0)
+        transform = tri.transform[simplex[inside]]
+        partial = np.einsum('ijk,ik->ij', transform[:, :2, :], self.aa[inside] - transform[:, 2, :])
+        barycentric = np.column_stack([partial, 1.0 - partial.sum(axis=1)])
+        W = csr_matrix((barycentric.ravel(), (np.repeat(inside, 3), tri.simplices[simplex[inside]].ravel())),
+                       shape=(len(self.aa), len(beams)))
+        outside = simplex < 0
+        if self._mask is not None:
+            outside |= ~self._mask
+        if len(self._cache) >= self.cache_size: # drop the oldest layout
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = (W, outside)
+        return W, outside
+
+    def render_values(self, theta_phi:np.ndarray, values:np.ndarray) -> np.ndarray:
+        '''interpolate the values at the (x, y) points over the grid, the packets of a beam are averaged'''
+        beams, inverse = np.unique(np.round(theta_phi, 9), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        mean = np.bincount(inverse, weights=values) / np.bincount(inverse)
+        W, outside = self.weights(beams)
+        yy_pred = W @ mean
+        yy_pred[outside] = np.nan
+        self.theta_phi = beams; self.csi_mag = mean
+        self.yy_pred = yy_pred
+        return yy_pred
+
+    def render(self, data:list[dict]) -> np.ndarray:
+        '''interpolate the beamscan csi data (as saved by rx_beamscan) over the grid'''
+        theta_phi, csi_mag = self.extract_plot_data(data)
+        return self.render_values(theta_phi, csi_mag)
+
+    def fit(self):
+        '''nothing to fit, see render'''
+        pass
@@ -23,12 +23,21 @@ from gnuradio import eng_notation
 from gnuradio import uhd
 import time
 from gnuradio import zeromq
+from xmlrpc.server import SimpleXMLRPCServer
+import threading
 from wifi_phy_hier import wifi_phy_hier  # grc-generated hier_block
 import foo
 import ieee802_11
 
 
 
+def snipfcn_snippet_ready(self):
+    print("FLOWGRAPH READY", flush=True)
+
+
+def snippets_main_after_start(tb):
+    snipfcn_snippet_ready(tb)
+
 
 class wifi_transceiver_nogui(gr.top_block):
 
@@ -44,7 +53,7 @@ class wifi_transceiver_nogui(gr.top_block):
         self.pdu_length = pdu_length = 150
         self.lo_offset = lo_offset = 0
         self.interval = interval = 750
-        self.freq = freq = 2452000000
+        self.freq = freq = 2452e6
         self.encoding = encoding = 0
         self.chan_est = chan_est = 0
 
@@ -52,6 +61,11 @@ class wifi_transceiver_nogui(gr.top_block):
         # Blocks
         ##################################################
 
+        self.xmlrpc_server_0 = SimpleXMLRPCServer(('127.0.0.1', 64002), allow_none=True)
+        self.xmlrpc_server_0.register_instance(self)
+        self.xmlrpc_server_0_thread = threading.Thread(target=self.xmlrpc_server_0.serve_forever)
+        self.xmlrpc_server_0_thread.daemon = True
+        self.xmlrpc_server_0_thread.start()
         self.zeromq_push_sink_0 = zeromq.push_sink(gr.sizeof_gr_complex, 52, 'tcp://127.0.0.1:64000', 100, False, (-1), True)
         self.zeromq_pull_msg_source_0 = zeromq.pull_msg_source('tcp://127.0.0.1:64001', 100, False)
         self.wifi_phy_hier_0 = wifi_phy_hier(
@@ -194,6 +208,7 @@ def main(top_block_cls=wifi_transceiver_nogui, options=None):
     signal.signal(signal.SIGTERM, sig_handler)
 
     tb.start()
+    snippets_main_after_start(tb)
 
     try:
         input('Press Enter to quit: ')
@@ -5,8 +5,18 @@
 # the spatial images are rotated 90deg counter clockwise
 # the camera image is cropped to a left-justified square
 
+# the directory is scanned once and the matching images are streamed in batches to a process pool,
+# outputs newer than their input are skipped (incremental runs), so it can be rerun on a growing trial
+# usage:
+#   python post_process/crop_rotate.py /home/sunlab/beamscan_data/trial_2 /home/sunlab/beamscan_data/trial_2_processed
+#   python post_process/crop_rotate.py IN OUT --camera-size 224 --workers 8
+
+import argparse
+import math
 import os
-from typing import List, Tuple
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Tuple
 from PIL import Image, ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # In case of broken images
@@ -29,65 +39,190 @@ def parse_images(directory: str, suffix: str, extension: str) -> List[str]:
     return matched_images
 
 
-if __name__ == "__main__":
-    input_directory = '/home/sunlab/beamscan_data/trial_2'
-    output_directory = '/home/sunlab/beamscan_data/trial_2_processed'
-    camera_suffix = 'camera'
-    camera_extension = '.jpg'
-    # set to crop the 1080x1920 image to a 1080x1080 square (left-justified)
-    camera_crop = (0, 0, 1080, 1080) # (left, upper, right, lower)
+def scan_images(directory: str, patterns: dict) -> Iterator[Tuple[str, str, float]]:
+    """
+    Walk the directory once and stream the images matching any of the patterns.
 
-    spatial_suffix = 'heatmap'
-    spatial_extension = '.png'
-    spatial_rotate =  90 # degrees counter clockwise
+    :param directory: Path to the directory to search.
+    :param patterns: {kind: suffix + extension}, e.g. {'camera': 'camera.jpg', 'spatial': 'heatmap.png'}.
+    :return: Iterator of (kind, path, mtime) tuples.
+    """
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'): # skip the artifact store staging directories
+                        stack.append(entry.path)
+                    continue
+                for kind, ending in patterns.items():
+                    if entry.name.endswith(ending):
+                        yield kind, entry.path, entry.stat().st_mtime
+                        break
+
+
+def is_up_to_date(output_path: str, input_mtime: float) -> bool:
+    """
+    True if the output exists and is newer than its input.
+    """
+    try:
+        return os.stat(output_path).st_mtime >= input_mtime
+    except FileNotFoundError:
+        return False
 
-    # check if the input directory exists
-    if not os.path.exists(input_directory):
-        print(f"Directory {input_directory} does not exist.")
-        exit(1)
 
-    # Parse images in the input directory
-    cameral_images = parse_images(input_directory, camera_suffix, camera_extension)
-    spatial_images = parse_images(input_directory, spatial_suffix, spatial_extension)
+def load_camera(image_path: str, crop: Tuple[int, int, int, int],
+                size: Tuple[int, int] | None = None) -> Image.Image:
+    """
+    Load a camera image cropped (and resized if size is given).
 
-    print(f"Found {len(cameral_images)} camera images and {len(spatial_images)} spatial images in {input_directory}")
-    if len(cameral_images) == 0 or len(spatial_images) == 0:
-        print("No images found, exiting.")
-        exit(1)
+    With a size the JPEG is decoded at a reduced scale (PIL draft mode) that still covers the
+    requested size, which is much faster than decoding the full 1920x1080 image.
+    """
+    with Image.open(image_path) as img:
+        box = crop
+        if size is not None and img.format == 'JPEG':
+            full_width = img.width
+            crop_width, crop_height = crop[2] - crop[0], crop[3] - crop[1]
+            # smallest decode size whose crop is still at least the output size
+            img.draft('RGB', (math.ceil(img.width * size[0] / crop_width),
+                              math.ceil(img.height * size[1] / crop_height)))
+            scale = full_width / img.width
+            box = tuple(round(c / scale) for c in crop)
+        img = img.crop(box)
+        if size is not None:
+            img = img.resize(size, Image.Resampling.LANCZOS)
+        return img
+
+
+def crop_camera(image_path: str, output_path: str, crop: Tuple[int, int, int, int],
+                size: Tuple[int, int] | None = None):
+    """
+    Crop a camera image (and resize it if size is given), see load_camera.
+    """
+    load_camera(image_path, crop, size).save(output_path)
 
-    # Ensure output directory exists
-    os.makedirs(output_directory) # raises an error if the output directory already exists
-    
-    print("Processing camera images...")
-    # Process camera images (crop to square, left-justified)
-    for image_path in cameral_images:
-        try:
-            with Image.open(image_path) as img:
-                img:Image.Image = img.crop(camera_crop)
-                # Save processed image
-                filename = os.path.basename(image_path)
-                output_path = os.path.join(output_directory, filename)
-                img.save(output_path)
-                print(f"Processed image {image_path} and saved to {output_path}")
-        except Exception as e:
-            print(f"Failed to process image {image_path}: {e}")
 
-    print()
-    print("Processing camera images complete.")
-    print()
-    print("Processing spatial images...")
+def rotate_spatial(image_path: str, output_path: str, angle: float):
+    """
+    Rotate a spatial (heatmap) image counter clockwise.
+    """
+    with Image.open(image_path) as img:
+        img.rotate(angle).save(output_path)
+
 
-    # Process spatial images (rotate 90 degrees counter clockwise)
-    for image_path in spatial_images:
+def process_batch(batch: List[Tuple[str, str, str]], settings: dict) -> Tuple[int, int, int]:
+    """
+    Process a batch of (kind, input path, output path) in a worker process.
+
+    :return: (processed, failed, input bytes)
+    """
+    processed = failed = nbytes = 0
+    for kind, image_path, output_path in batch:
         try:
-            with Image.open(image_path) as img:
-                img:Image.Image = img.rotate(spatial_rotate)
-                # Save processed image
-                filename = os.path.basename(image_path)
-                output_path = os.path.join(output_directory, filename)
-                img.save(output_path)
-                print(f"Processed image {image_path} and saved to {output_path}")
+            if kind == 'camera':
+                crop_camera(image_path, output_path, settings['camera_crop'], settings['camera_size'])
+            else:
+                rotate_spatial(image_path, output_path, settings['spatial_rotate'])
+            processed += 1
+            nbytes += os.path.getsize(image_path)
         except Exception as e:
+            failed += 1
             print(f"Failed to process image {image_path}: {e}")
-    
-    print("Processing complete.")
+    return processed, failed, nbytes
+
+
+def process_directory(input_directory: str, output_directory: str,
+                      camera_crop: Tuple[int, int, int, int] = (0, 0, 1080, 1080),
+                      camera_size: Tuple[int, int] | None = None,
+                      spatial_rotate: float = 90,
+                      camera_pattern: str = 'camera.jpg', spatial_pattern: str = 'heatmap.png',
+                      workers: int | None = None, batch_size: int = 64, force: bool = False) -> dict:
+    """
+    Crop the camera images and rotate the spatial images of a directory tree into the output directory.
+
+    :param input_directory: Path to the directory to search (recursively).
+    :param output_directory: Path of the (flat) output directory, created if needed.
+    :param camera_crop: (left, upper, right, lower) crop of the camera images.
+    :param camera_size: Optional (width, height) the cropped camera images are resized to.
+    :param spatial_rotate: Degrees counter clockwise the spatial images are rotated.
+    :param workers: Number of worker processes (default: cpu count).
+    :param batch_size: Number of images sent to a worker at a time.
+    :param force: Process images whose output is already up to date.
+    :return: Statistics {'found', 'skipped', 'processed', 'failed', 'seconds', 'images_per_second'}.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    settings = {'camera_crop': camera_crop, 'camera_size': camera_size, 'spatial_rotate': spatial_rotate}
+    patterns = {'camera': camera_pattern, 'spatial': spatial_pattern}
+    workers = workers or os.cpu_count()
+    stats = {'found': 0, 'skipped': 0, 'processed': 0, 'failed': 0, 'bytes': 0}
+
+    def collect(done_futures):
+        for future in done_futures:
+            processed, failed, nbytes = future.result()
+            stats['processed'] += processed; stats['failed'] += failed; stats['bytes'] += nbytes
+        elapsed = time.time() - start_time
+        print(f"Processed {stats['processed']} images ({stats['processed'] / elapsed:.1f} images/s, "
+              f"{stats['bytes'] / elapsed / 1e6:.1f} MB/s)")
+
+    start_time = time.time()
+    pending = set()
+    batch = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for kind, image_path, mtime in scan_images(input_directory, patterns):
+            stats['found'] += 1
+            output_path = os.path.join(output_directory, os.path.basename(image_path))
+            if not force and is_up_to_date(output_path, mtime):
+                stats['skipped'] += 1
+                continue
+            batch.append((kind, image_path, output_path))
+            if len(batch) == batch_size:
+                pending.add(executor.submit(process_batch, batch, settings))
+                batch = []
+                if len(pending) >= 2 * workers: # bound the work in flight while the scan continues
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+        if batch:
+            pending.add(executor.submit(process_batch, batch, settings))
+        collect(wait(pending).done)
+
+    stats['seconds'] = time.time() - start_time
+    stats['images_per_second'] = stats['processed'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description="Crop camera images and rotate spatial images of a trial")
+    parser.add_argument("input_directory", nargs='?', default='/home/sunlab/beamscan_data/trial_2')
+    parser.add_argument("output_directory", nargs='?', default='/home/sunlab/beamscan_data/trial_2_processed')
+    # set to crop the 1080x1920 image to a 1080x1080 square (left-justified)
+    parser.add_argument("--camera-crop", type=int, nargs=4, default=(0, 0, 1080, 1080),
+                        metavar=("LEFT", "UPPER", "RIGHT", "LOWER"))
+    parser.add_argument("--camera-size", type=int, default=None,
+                        help="resize the cropped camera images to a SIZE x SIZE square (faster JPEG decoding)")
+    parser.add_argument("--rotate", type=float, default=90, help="degrees counter clockwise for spatial images")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--force", action="store_true", help="also process images whose output is up to date")
+    args = parser.parse_args(argv)
+
+    # check if the input directory exists
+    if not os.path.exists(args.input_directory):
+        print(f"Directory {args.input_directory} does not exist.")
+        exit(1)
+
+    camera_size = None if args.camera_size is None else (args.camera_size, args.camera_size)
+    stats = process_directory(args.input_directory, args.output_directory,
+                              camera_crop=tuple(args.camera_crop), camera_size=camera_size,
+                              spatial_rotate=args.rotate, workers=args.workers,
+                              batch_size=args.batch_size, force=args.force)
+    print(f"Found {stats['found']} images in {args.input_directory}, {stats['skipped']} up to date")
+    print(f"Processed {stats['processed']} images ({stats['failed']} failed) in {stats['seconds']:.1f} seconds, "
+          f"{stats['images_per_second']:.1f} images/s")
+    if stats['found'] == 0:
+        print("No images found, exiting.")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
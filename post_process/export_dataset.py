@@ -0,0 +1,249 @@
+# this exports the collected beamscans into a training-ready dataset of paired records
+# each record holds the cropped camera image, the GP heatmap (mean and std) at native float64 precision,
+# the raw CSI of every packet and the beam metadata, all with a fixed size
+# records are written back to back into binary shards (numpy structured dtype) with a json index,
+# so a data loader reads them sequentially (or with np.memmap) instead of opening millions of small files
+
+# a scan is exported if it has a {base}_beamscan_csi.pkl (or .csiz archive), a {base}_camera.jpg and a {base}_gp.npz
+# (run reprocess_gp.py first for the scans without a compact GP model)
+
+# usage:
+#   python post_process/export_dataset.py /home/sunlab/beamscan_data /home/sunlab/beamscan_dataset
+#   python post_process/export_dataset.py DATA OUT --image-size 224 --records-per-shard 512 --workers 8
+# reading:
+#   dataset = BeamscanDataset('/home/sunlab/beamscan_dataset'); record = dataset[0]; record['heatmap']
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+root_path = Path(__file__).absolute().parent.parent # the repository root, for gp.py
+sys.path.insert(0, str(root_path))
+sys.path.insert(0, str(Path(__file__).absolute().parent)) # post_process, for crop_rotate.py
+
+from artifact_writer import write_atomic
+from crop_rotate import load_camera
+from csi_codec import ARCHIVE_SUFFIX, load_csi_data
+from gp import load_model
+
+CSI_SUFFIX = "_beamscan_csi.pkl"
+CAMERA_SUFFIX = "_camera.jpg"
+MODEL_SUFFIX = "_gp.npz"
+INDEX_FILENAME = "index.json"
+NUM_SUBCARRIERS = 52
+
+
+def find_scans(data_root:str) -> tuple[list[str], int]:
+    '''return the sorted base filenames of the scans with csi, camera and GP model files
+    and the number of csi files missing one of the other two'''
+    bases = []; incomplete = 0
+    for root, dirs, files in os.walk(data_root):
+        dirs[:] = [d for d in dirs if not d.startswith('.')] # skip the artifact store staging directories
+        names = set(files)
+        for file in files:
+            if file.endswith(CSI_SUFFIX) or \
+                    (file.endswith(ARCHIVE_SUFFIX) and file[:-len(ARCHIVE_SUFFIX)] + CSI_SUFFIX not in names):
+                base = file[:-len(CSI_SUFFIX if file.endswith(CSI_SUFFIX) else ARCHIVE_SUFFIX)]
+                if base + CAMERA_SUFFIX in names and base + MODEL_SUFFIX in names:
+                    bases.append(os.path.join(root, base))
+                else:
+                    incomplete += 1
+    return sorted(bases), incomplete
+
+def csi_filename(base:str) -> str:
+    '''the csi file of a scan, the pickle or else the compressed archive'''
+    return base + CSI_SUFFIX if os.path.exists(base + CSI_SUFFIX) else base + ARCHIVE_SUFFIX
+
+def record_dtype(image_size:int, grid_resolution:int, num_entries:int) -> np.dtype:
+    '''the fixed size record of one scan'''
+    return np.dtype([
+        ('scan_id', 'S64'), # base filename of the scan (timestamp)
+        ('image', 'u1', (image_size, image_size, 3)), # cropped camera image, RGB
+        ('heatmap', '<f8', (2, grid_resolution, grid_resolution)), # GP mean and std (full grid), image orientation
+        ('csi', '<c8', (num_entries, NUM_SUBCARRIERS)), # raw CSI per packet (the first vector), NaN if not received
+        ('csi_valid', '?', (num_entries,)), # False for lost packets and padding
+        ('beam', '<f4', (num_entries, 3)), # beam_gain, theta, phi per packet
+        ('timestamp', '<f8', (num_entries,)), # transmit time per packet
+    ])
+
+def heatmap_image_orientation(data:np.ndarray, resolution:int, rotate:int) -> np.ndarray:
+    '''arrange the flat GP grid like the saved png (origin lower) rotated by rotate*90 deg counter clockwise
+    (the orientation of the crop_rotate.py outputs for rotate=1)'''
+    return np.rot90(data.reshape((resolution, resolution))[::-1], k=rotate)
+
+def build_record(base:str, settings:dict) -> bytes|None:
+    '''build the record bytes of a scan (runs in a worker process), None if the scan does not fit'''
+    dtype = record_dtype(settings['image_size'], settings['grid_resolution'], settings['num_entries'])
+    record = np.zeros((), dtype=dtype)
+    record['scan_id'] = os.path.basename(base).encode('utf-8')
+
+    size = (settings['image_size'], settings['image_size'])
+    record['image'] = np.asarray(load_camera(base + CAMERA_SUFFIX, settings['camera_crop'], size).convert('RGB'))
+
+    model = load_model(base + MODEL_SUFFIX)
+    if model.grid is None or model.grid['resolution'] != settings['grid_resolution']:
+        print(f"Skipping {base}: GP grid resolution does not match {settings['grid_resolution']}")
+        return None
+    # the full grid, a model fitted with the cone mask (gp.STEER_THETA_MAX) would be NaN outside the cone
+    y_mean, y_std = model.predict_grid(return_std=True, full=True)
+    for channel, data in enumerate((y_mean, y_std)):
+        record['heatmap'][channel] = heatmap_image_orientation(data, settings['grid_resolution'],
+                                                               settings['heatmap_rotate'])
+
+    csi_data = load_csi_data(csi_filename(base))
+    if len(csi_data) > settings['num_entries']:
+        print(f"Skipping {base}: {len(csi_data)} packets, the records hold {settings['num_entries']}")
+        return None
+    record['csi'][:] = np.nan
+    truncated = 0 # packets with several csi vectors (one zmq message), the first vector is kept
+    for ii, entry in enumerate(csi_data):
+        if entry.get('csi') is not None and len(entry['csi']) >= NUM_SUBCARRIERS:
+            truncated += len(entry['csi']) > NUM_SUBCARRIERS
+            record['csi'][ii] = entry['csi'][:NUM_SUBCARRIERS]
+            record['csi_valid'][ii] = True
+        beam = entry['beam']
+        record['beam'][ii] = (beam['beam_gain'], beam['theta'], beam['phi'])
+        record['timestamp'][ii] = entry.get('timestamp', np.nan)
+    if truncated:
+        print(f"{base}: {truncated} packets hold several csi vectors, only the first is exported")
+    return record.tobytes()
+
+
+class ShardWriter():
+    '''Writes fixed size records back to back into numbered shard files, then the json index'''
+    def __init__(self, output_directory:str, dtype:np.dtype, records_per_shard:int, info:dict):
+        self.output_directory = output_directory
+        self.dtype = dtype
+        self.records_per_shard = records_per_shard
+        self.info = info
+        self.shards:list[dict] = []
+        self.scan_ids:list[str] = []
+        self._file = None; self._tmp_filename = None
+
+    def _close_shard(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self._tmp_filename, os.path.join(self.output_directory, self.shards[-1]['file']))
+            self._file = None
+
+    def write(self, scan_id:str, record:bytes):
+        '''append a record, starting a new shard when the current one is full'''
+        if self._file is None or self.shards[-1]['count'] == self.records_per_shard:
+            self._close_shard()
+            filename = f"shard-{len(self.shards):05d}.bin"
+            self._tmp_filename = os.path.join(self.output_directory, filename + ".tmp")
+            self._file = open(self._tmp_filename, 'wb')
+            self.shards.append({'file': filename, 'count': 0})
+        self._file.write(record)
+        self.shards[-1]['count'] += 1
+        self.scan_ids.append(scan_id)
+
+    def close(self):
+        '''close the last shard and write the index'''
+        self._close_shard()
+        index = dict(self.info)
+        index.update({'format': 'beamscan_dataset', 'version': 1,
+                      'dtype': np.lib.format.dtype_to_descr(self.dtype), 'record_size': self.dtype.itemsize,
+                      'num_records': len(self.scan_ids), 'shards': self.shards, 'scan_ids': self.scan_ids})
+        write_atomic(os.path.join(self.output_directory, INDEX_FILENAME), json.dumps(index).encode('utf-8'))
+
+
+class BeamscanDataset():
+    '''Random access reader of an exported dataset, the shards are memory mapped
+    dataset[i] returns a numpy structured record (fields: scan_id, image, heatmap, csi, csi_valid, beam, timestamp)'''
+    def __init__(self, directory:str):
+        with open(os.path.join(directory, INDEX_FILENAME)) as file:
+            self.index = json.load(file)
+        if self.index.get('format') != 'beamscan_dataset':
+            raise ValueError(f"{directory} is not a beamscan dataset")
+        self.dtype = np.lib.format.descr_to_dtype([tuple(field) for field in self.index['dtype']])
+        self.shards = [np.memmap(os.path.join(directory, shard['file']), dtype=self.dtype, mode='r',
+                                 shape=(shard['count'],)) for shard in self.index['shards']]
+        self._starts = np.cumsum([0] + [shard['count'] for shard in self.index['shards']])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def __getitem__(self, ii:int):
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError(ii)
+        shard = int(np.searchsorted(self._starts, ii, side='right')) - 1
+        return self.shards[shard][ii - self._starts[shard]]
+
+
+def export_dataset(data_root:str, output_directory:str, image_size:int=224,
+                   camera_crop:tuple=(0, 0, 1080, 1080), heatmap_rotate:int=1,
+                   num_entries:int|None=None, records_per_shard:int=256, workers:int|None=None) -> dict:
+    '''export all the complete scans under data_root into shards + index in output_directory
+    num_entries: packets per record (shorter scans are padded), default: the first scan's length
+    returns statistics {'found', 'incomplete', 'exported', 'skipped', 'seconds'}'''
+    bases, incomplete = find_scans(data_root)
+    print(f"Found {len(bases)} complete scans in {data_root} ({incomplete} without camera image or GP model)")
+    if not bases:
+        return {'found': 0, 'incomplete': incomplete, 'exported': 0, 'skipped': 0, 'seconds': 0.0}
+    os.makedirs(output_directory, exist_ok=True)
+
+    # the fixed record layout comes from the first scan
+    if num_entries is None:
+        num_entries = len(load_csi_data(csi_filename(bases[0])))
+    grid_resolution = load_model(bases[0] + MODEL_SUFFIX).grid['resolution']
+    settings = {'image_size': image_size, 'camera_crop': tuple(camera_crop), 'heatmap_rotate': heatmap_rotate,
+                'grid_resolution': grid_resolution, 'num_entries': num_entries}
+    dtype = record_dtype(image_size, grid_resolution, num_entries)
+    print(f"Record size: {dtype.itemsize / 1e6:.2f} MB ({num_entries} packets, {grid_resolution}px heatmap, "
+          f"{image_size}px image)")
+
+    writer = ShardWriter(output_directory, dtype, records_per_shard, info={'settings': settings})
+    start_time = time.time()
+    exported = skipped = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map keeps the scan order, the records are written sequentially as they arrive
+        for base, record in zip(bases, executor.map(build_record, bases, [settings] * len(bases), chunksize=4)):
+            if record is None:
+                skipped += 1
+                continue
+            writer.write(os.path.basename(base), record)
+            exported += 1
+            if exported % 100 == 0:
+                print(f"Exported {exported} records ({exported / (time.time() - start_time):.1f} records/s)")
+    writer.close()
+    seconds = time.time() - start_time
+    return {'found': len(bases), 'incomplete': incomplete, 'exported': exported, 'skipped': skipped,
+            'seconds': seconds}
+
+
+def main(argv:list[str]|None=None):
+    parser = argparse.ArgumentParser(description="Export beamscans into sharded, fixed size training records")
+    parser.add_argument("data_root", help="directory searched (recursively) for complete scans")
+    parser.add_argument("output_directory", help="directory of the shards and index.json")
+    parser.add_argument("--image-size", type=int, default=224, help="camera images are cropped and resized to this")
+    parser.add_argument("--camera-crop", type=int, nargs=4, default=(0, 0, 1080, 1080),
+                        metavar=("LEFT", "UPPER", "RIGHT", "LOWER"))
+    parser.add_argument("--heatmap-rotate", type=int, default=1,
+                        help="quarter turns counter clockwise applied to the heatmaps (1 matches crop_rotate.py)")
+    parser.add_argument("--num-entries", type=int, default=None,
+                        help="packets per record (shorter scans are padded), default: the first scan's length")
+    parser.add_argument("--records-per-shard", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.data_root):
+        print(f"Directory {args.data_root} does not exist.")
+        exit(1)
+    stats = export_dataset(args.data_root, args.output_directory, image_size=args.image_size,
+                           camera_crop=tuple(args.camera_crop), heatmap_rotate=args.heatmap_rotate,
+                           num_entries=args.num_entries, records_per_shard=args.records_per_shard,
+                           workers=args.workers)
+    print(f"Exported {stats['exported']} records ({stats['skipped']} skipped) in {stats['seconds']:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
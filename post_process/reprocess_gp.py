@@ -0,0 +1,182 @@
+# this regenerates the GP heatmaps/models of existing beamscans (ex. after changing the kernel)
+# it finds every *_beamscan_csi.pkl (or compressed .csiz archive) under a data root, fits and renders them in a process pool
+# and skips the scans whose outputs are up to date (same csi file content and same settings)
+
+# each scan gets a {base}_reprocess.json record written after all its outputs,
+# so an interrupted run is resumed by running the same command again
+
+# usage:
+#   python post_process/reprocess_gp.py /home/sunlab/beamscan_data --workers 8
+#   python post_process/reprocess_gp.py /home/sunlab/beamscan_data --kernel matern --length-scale 0.2 \
+#       --output /home/sunlab/beamscan_data_matern
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+root_path = Path(__file__).absolute().parent.parent # the repository root, for gp.py
+sys.path.insert(0, str(root_path))
+
+from sklearn.gaussian_process.kernels import RBF, Matern, WhiteKernel, ConstantKernel as C
+
+from artifact_writer import write_atomic
+from csi_codec import ARCHIVE_SUFFIX, load_csi_data
+from gp import GaussianProcess
+
+CSI_SUFFIX = "_beamscan_csi.pkl"
+RECORD_SUFFIX = "_reprocess.json"
+
+
+def find_scans(data_root:str) -> list[str]:
+    '''return the sorted paths of all the beamscan csi files (pickles or archives) under the data root
+    a scan saved in both formats is listed once (the pickle)'''
+    scans = []
+    for root, dirs, files in os.walk(data_root):
+        dirs[:] = [d for d in dirs if not d.startswith('.')] # skip the artifact store staging directories
+        names = set(files)
+        for file in files:
+            if file.endswith(CSI_SUFFIX) or \
+                    (file.endswith(ARCHIVE_SUFFIX) and file[:-len(ARCHIVE_SUFFIX)] + CSI_SUFFIX not in names):
+                scans.append(os.path.join(root, file))
+    return sorted(scans)
+
+def output_base(csi_path:str, data_root:str, output_root:str) -> str:
+    '''the base filename of the outputs of a scan, output_root mirrors the layout of the data root'''
+    suffix = CSI_SUFFIX if csi_path.endswith(CSI_SUFFIX) else ARCHIVE_SUFFIX
+    relative = os.path.relpath(csi_path, data_root)[:-len(suffix)]
+    return os.path.join(output_root, relative)
+
+def output_files(base:str, config:dict) -> list[str]:
+    '''the files written for a scan with the given settings'''
+    files = [f"{base}_gp_heatmap.png", f"{base}_gp_heatmap_std.png", f"{base}_gp.npz"]
+    if config['html']:
+        files.append(f"{base}_plots.html")
+    return files
+
+def content_hash(csi_path:str, config:dict) -> str:
+    '''sha256 of the csi file content and the settings, the outputs are up to date if it is unchanged'''
+    digest = hashlib.sha256()
+    with open(csi_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def is_up_to_date(base:str, config:dict, scan_hash:str) -> bool:
+    '''True if the record of the scan matches the hash and all the outputs exist'''
+    try:
+        with open(f"{base}{RECORD_SUFFIX}") as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return record.get('hash') == scan_hash and all(os.path.exists(f) for f in output_files(base, config))
+
+def build_kernel(config:dict):
+    '''the GP kernel for the settings, None for the GaussianProcess default kernel'''
+    if config['kernel'] == 'default':
+        return None
+    base = RBF(length_scale=config['length_scale']) if config['kernel'] == 'rbf' \
+        else Matern(length_scale=config['length_scale'], nu=config['nu'])
+    return C(config['constant']) * base + WhiteKernel(config['noise'])
+
+def process_scan(csi_path:str, base:str, config:dict, scan_hash:str) -> tuple[str, float]:
+    '''fit and render one scan (runs in a worker process), returns (csi_path, seconds)'''
+    start_time = time.time()
+    csi_data = load_csi_data(csi_path)
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+
+    gp = GaussianProcess(csi_data, linespace_density=config['density'], kernel=build_kernel(config),
+                         backend=config['backend'], aggregate=config['aggregate'],
+                         mask_cone=config['mask_cone'])
+    if not config['optimize']: # keep the given hyperparameters
+        gp.gp.set_params(optimizer=None)
+    gp.fit()
+    gp.save_image(data=gp.yy_pred, filename=f"{base}_gp_heatmap.png")
+    gp.save_image(data=gp.yy_std, filename=f"{base}_gp_heatmap_std.png")
+    gp.save_model(filename=f"{base}_gp.npz")
+    if config['html']:
+        gp.plot_report(filename=f"{base}_plots.html", title=os.path.basename(base))
+    # the record is written last: a scan without it (or with another hash) is processed again
+    record = {'hash': scan_hash, 'source': os.path.abspath(csi_path), 'config': config,
+              'kernel': str(gp.gp.kernel_), 'processed': time.strftime("%Y%m%d-%H%M%S")}
+    write_atomic(f"{base}{RECORD_SUFFIX}", json.dumps(record, indent=2).encode('utf-8'))
+    return csi_path, time.time() - start_time
+
+
+def main(argv:list[str]|None=None):
+    parser = argparse.ArgumentParser(description="Regenerate the GP heatmaps of existing beamscans")
+    parser.add_argument("data_root", help="directory searched (recursively) for *_beamscan_csi.pkl/.csiz files")
+    parser.add_argument("--output", default=None, help="output root (mirrors the data root), default: in place")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--kernel", choices=["default", "rbf", "matern"], default="default",
+                        help="'default' is the GaussianProcess default kernel, else C * RBF|Matern + White")
+    parser.add_argument("--length-scale", type=float, default=0.179)
+    parser.add_argument("--constant", type=float, default=0.0224**2)
+    parser.add_argument("--noise", type=float, default=2.79e-05)
+    parser.add_argument("--nu", type=float, default=1.5, help="Matern smoothness")
+    parser.add_argument("--no-optimize", action="store_true", help="keep the kernel hyperparameters fixed")
+    parser.add_argument("--backend", choices=["exact", "sparse"], default="exact")
+    parser.add_argument("--density", type=int, default=180, help="grid resolution (image size in pixels)")
+    parser.add_argument("--no-aggregate", action="store_true", help="fit one point per packet")
+    parser.add_argument("--full-grid", action="store_true",
+                        help="predict the whole square grid, not only inside the steerable cone")
+    parser.add_argument("--html", action="store_true", help="also write the compact html report")
+    parser.add_argument("--force", action="store_true", help="process up to date scans as well")
+    args = parser.parse_args(argv)
+
+    config = {'kernel': args.kernel, 'length_scale': args.length_scale, 'constant': args.constant,
+              'noise': args.noise, 'nu': args.nu, 'optimize': not args.no_optimize, 'backend': args.backend,
+              'density': args.density, 'aggregate': not args.no_aggregate, 'html': args.html,
+              'mask_cone': not args.full_grid}
+    output_root = args.data_root if args.output is None else args.output
+
+    if not os.path.exists(args.data_root):
+        print(f"Directory {args.data_root} does not exist.")
+        exit(1)
+    scans = find_scans(args.data_root)
+    print(f"Found {len(scans)} beamscans in {args.data_root}")
+
+    # skip the scans that are up to date
+    jobs = []
+    for csi_path in scans:
+        base = output_base(csi_path, args.data_root, output_root)
+        scan_hash = content_hash(csi_path, config)
+        if args.force or not is_up_to_date(base, config, scan_hash):
+            jobs.append((csi_path, base, scan_hash))
+    print(f"{len(scans) - len(jobs)} up to date, processing {len(jobs)} with {args.workers} workers")
+    if not jobs:
+        return
+
+    start_time = time.time()
+    done = 0; failed = 0
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(process_scan, csi_path, base, config, scan_hash): csi_path
+                   for csi_path, base, scan_hash in jobs}
+        for future in as_completed(futures):
+            try:
+                _, seconds = future.result()
+                done += 1
+                elapsed = time.time() - start_time
+                print(f"[{done + failed}/{len(jobs)}] {futures[future]} ({seconds:.1f}s, "
+                      f"{done / elapsed:.2f} scans/s)")
+            except Exception:
+                failed += 1
+                print(f"[{done + failed}/{len(jobs)}] Failed to process {futures[future]}:")
+                traceback.print_exc()
+    except KeyboardInterrupt:
+        print("Interrupted, finished scans are kept, run the same command again to resume.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        exit(1)
+    executor.shutdown()
+    print(f"Processed {done} scans ({failed} failed) in {time.time() - start_time:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# this plans the order in which beams (or tx/rx beam pairs) are visited during a scan
+
+# pair orderings of a joint tx/rx sweep (indices into the tx and rx beam lists):
+#   'grid'         tx-major, every rx beam for each tx beam (the tx bbox is steered once per row)
+#   'rx_major'     rx-major, every tx beam for each rx beam (the rx bbox is steered once per row)
+#   'hierarchical' coarse to fine: every 4th tx and rx beam first, then every 2nd, then the rest,
+#                  a partial sweep (ex. stopped at a deadline) still covers the whole tx x rx space
+
+from dataclasses import dataclass, field, replace
+
+import numpy as np
+
+PAIR_ORDERS = ('grid', 'rx_major', 'hierarchical')
+
+
+def pair_order(n_tx:int, n_rx:int, order:str='grid', coarse_stride:int=4) -> list[tuple[int, int]]:
+    '''the (tx, rx) index pairs of a joint sweep in the given order, every pair exactly once'''
+    if order == 'grid':
+        return [(tx, rx) for tx in range(n_tx) for rx in range(n_rx)]
+    if order == 'rx_major':
+        return [(tx, rx) for rx in range(n_rx) for tx in range(n_tx)]
+    if order == 'hierarchical':
+        pairs = []; seen = set()
+        stride = max(1, coarse_stride)
+        while True:
+            level = [(tx, rx) for tx in range(0, n_tx, stride) for rx in range(0, n_rx, stride)
+                     if (tx, rx) not in seen]
+            pairs.extend(level); seen.update(level)
+            if stride == 1:
+                return pairs
+            stride = max(1, stride // 2)
+    raise ValueError(f"order must be one of {PAIR_ORDERS}")
+
+
+# ------------------------------------------ BEAM ORDERING ------------------------------------------
+# beam orderings of a single device raster (the beam weights change with the move in the x, y plane of
+# the direction cosines, a short move is a small phase change on every element):
+#   'raster'      as listed, theta-major (every theta row jumps phi from ~340 deg back to 0 deg)
+#   'serpentine'  theta rows with alternating phi direction
+#   'nearest'     greedy nearest neighbour in (x, y) improved with 2-opt (shortest total move)
+
+BEAM_ORDERS = ('raster', 'serpentine', 'nearest')
+
+
+def beam_xy(beams:list[tuple[float, float]]) -> np.ndarray:
+    '''(theta, phi) degrees to (x, y) direction cosines'''
+    theta_phi = np.deg2rad(np.asarray(beams, dtype=np.float64).reshape(-1, 2))
+    return np.column_stack([np.sin(theta_phi[:, 0]) * np.cos(theta_phi[:, 1]),
+                            np.sin(theta_phi[:, 0]) * np.sin(theta_phi[:, 1])])
+
+def move_distances(beams:list[tuple[float, float]]) -> np.ndarray:
+    '''the (x, y) distance of each move between consecutive beams'''
+    xy = beam_xy(beams)
+    return np.hypot(*np.diff(xy, axis=0).T)
+
+def order_beams(beams:list[tuple[float, float]], order:str='serpentine') -> list[tuple[float, float]]:
+    '''reorder the beams of a raster, the first beam (boresight for BBox5G.raster_beams) stays first'''
+    beams = list(beams)
+    if order == 'raster' or len(beams) < 3:
+        return beams
+    if order == 'serpentine':
+        rows = {} # theta -> beams in the listed order
+        for beam in beams[1:]:
+            rows.setdefault(beam[0], []).append(beam)
+        ordered = [beams[0]]
+        for ii, row in enumerate(rows.values()):
+            ordered.extend(row if ii % 2 == 0 else row[::-1])
+        return ordered
+    if order == 'nearest':
+        xy = beam_xy(beams)
+        distance = np.hypot(xy[:, None, 0] - xy[None, :, 0], xy[:, None, 1] - xy[None, :, 1])
+        path = [0]; unvisited = np.ones(len(beams), dtype=bool); unvisited[0] = False
+        for _ in range(len(beams) - 1): # greedy nearest neighbour
+            candidates = np.where(unvisited, distance[path[-1]], np.inf)
+            path.append(int(np.argmin(candidates))); unvisited[path[-1]] = False
+        path = np.array(path)
+        for _ in range(10): # 2-opt: reverse a segment if it shortens the open path
+            improved = False
+            for i in range(1, len(path) - 1):
+                a, b = path[i - 1], path[i]
+                c = path[i:]; d = np.append(path[i + 1:], -1) # the end of the path has no successor
+                old = distance[a, b] + np.where(d >= 0, distance[c, d], 0)
+                new = distance[a, c] + np.where(d >= 0, distance[b, d], 0)
+                gain = old - new
+                j = int(np.argmax(gain))
+                if gain[j] > 1e-12:
+                    path[i:i + j + 1] = path[i:i + j + 1][::-1]
+                    improved = True
+            if not improved:
+                break
+        return [beams[ii] for ii in path]
+    raise ValueError(f"order must be one of {BEAM_ORDERS}")
+
+
+class SteerTimeModel():
+    '''Measured duration of a beam steer (the set_beam_angle call) as a function of the (x, y) move distance
+    every move from a known beam is observed (distance, seconds) and a line a + b * distance is fitted,
+    ScanPlan.estimate_duration predicts the steering time of a scan with it
+    (this is the host side call time, the settling of the array is not observable from it)
+    prior: the seconds per steer assumed before any steer is observed, conservative so a fresh manager
+    does not plan a deadline scan as if steering were free'''
+    def __init__(self, prior:float=0.05, min_samples:int=20, max_samples:int=5000):
+        self.prior = prior
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.distances:list[float] = []; self.seconds:list[float] = []
+        self.intercept:float|None = None; self.slope:float|None = None
+
+    def observe(self, distance:float, seconds:float):
+        '''record the measured time of one steer (the oldest samples are dropped)'''
+        self.distances.append(float(distance)); self.seconds.append(float(seconds))
+        if len(self.distances) > self.max_samples:
+            del self.distances[0]; del self.seconds[0]
+
+    def fit(self) -> bool:
+        '''fit the line to the observed steers, returns False if there are too few'''
+        if len(self.distances) < self.min_samples or np.ptp(self.distances) == 0:
+            return False
+        self.slope, self.intercept = np.polyfit(self.distances, self.seconds, 1)
+        self.slope = max(float(self.slope), 0.0); self.intercept = float(self.intercept)
+        return True
+
+    def transition_time(self, distance:float) -> float:
+        '''the predicted duration of a set_beam_angle call for a move
+        the prior without observations, the mean of the observations until there are enough to fit'''
+        if self.slope is None:
+            return float(np.mean(self.seconds)) if self.seconds else self.prior
+        return self.intercept + self.slope * distance
+
+
+# ------------------------------------------ SCAN PLAN ------------------------------------------
+# a scan plan compiles a scan profile (raster, order, dwell, timing) into the beam list of the scan and
+# predicts its duration from the measured latencies of the stages of the previous scans:
+#   steer   SteerTimeModel.transition_time of every move (distance dependent)
+#   packet  send, tx_gap, csi receive and packet_gap of one packet (StageLatency 'packet')
+#   beam    the per beam processing, ex. the online GP update (StageLatency 'beam')
+# usage:
+#   plan = ScanPlan(theta_step=5, phi_step=20).fit_to_deadline(3.0, bbox.raster_beams, steer_time, latency)
+#   bbox.scan_raster_generator(beams=plan.compile(bbox.raster_beams), steer_time=steer_time)
+
+class StageLatency():
+    '''Running (exponentially weighted) mean of the measured duration of the scan stages'''
+    def __init__(self, alpha:float=0.1):
+        self.alpha = alpha
+        self.means:dict[str, float] = {}
+        self.counts:dict[str, int] = {}
+
+    def observe(self, stage:str, seconds:float):
+        '''add a measured duration of a stage'''
+        if stage not in self.means:
+            self.means[stage] = float(seconds); self.counts[stage] = 1
+            return
+        self.means[stage] += self.alpha * (float(seconds) - self.means[stage])
+        self.counts[stage] += 1
+
+    def mean(self, stage:str, default:float=0.0) -> float:
+        '''the mean duration of a stage, default if it was not measured yet'''
+        return self.means.get(stage, default)
+
+
+@dataclass
+class ScanPlan():
+    '''Profile of an rx beamscan, the raster ranges and steps are those of BBox5G.raster_beams
+    tx_gap: sleep between sending a packet and polling its csi, packet_gap: sleep after each packet
+    csi_timeout: csi receive timeout in ms'''
+    theta_range:tuple[float, float] = (1.0, 45.0)
+    phi_range:tuple[float, float] = (0.0, 359.9)
+    theta_step:float = 5.0
+    phi_step:float = 20.0
+    packets_per_beam:int = 2
+    order:str = 'nearest'
+    tx_gap:float = 0.001
+    packet_gap:float = 0.010
+    csi_timeout:int = 7
+    beams:list[tuple[float, float]]|None = field(default=None, repr=False) # set by compile
+
+    def compile(self, raster) -> list[tuple[float, float]]|None:
+        '''the beams of the plan in scan order, raster is BBox5G.raster_beams (None if out of bounds)'''
+        beams = raster(list(self.theta_range), list(self.phi_range), self.theta_step, self.phi_step)
+        self.beams = None if beams is None else order_beams(beams, self.order)
+        return self.beams
+
+    def packet_time(self, latency:StageLatency|None=None) -> float:
+        '''the duration of one packet, measured or the upper bound of the sleeps and the csi timeout'''
+        bound = self.tx_gap + self.csi_timeout / 1000 + self.packet_gap
+        return bound if latency is None else latency.mean('packet', bound)
+
+    def estimate_duration(self, steer_time:SteerTimeModel|None=None, latency:StageLatency|None=None) -> float:
+        '''the predicted duration (seconds) of the compiled plan'''
+        if self.beams is None:
+            raise ValueError("The plan is not compiled")
+        steer = 0.0
+        if steer_time is not None:
+            distances = np.concatenate([[0.0], move_distances(self.beams)])
+            steer = sum(steer_time.transition_time(d) for d in distances)
+        beam = 0.0 if latency is None else latency.mean('beam')
+        return steer + len(self.beams) * (self.packets_per_beam * self.packet_time(latency) + beam)
+
+    def fit_to_deadline(self, seconds:float, raster, steer_time:SteerTimeModel|None=None,
+                        latency:StageLatency|None=None, max_scale:float=8.0) -> 'ScanPlan':
+        '''the finest compiled plan predicted to finish within seconds
+        the raster steps are coarsened step by step, at every raster the packets per beam are reduced to 1
+        before the raster is coarsened further (spatial resolution is worth more than averaging)
+        returns the coarsest candidate if none meets the deadline'''
+        scale = 1.0; plan = self
+        while scale <= max_scale:
+            for ppb in sorted({self.packets_per_beam, 1}, reverse=True):
+                plan = replace(self, theta_step=round(self.theta_step * scale, 1), phi_step=round(self.phi_step * scale, 1),
+                               packets_per_beam=ppb)
+                if plan.compile(raster) is not None and plan.estimate_duration(steer_time, latency) <= seconds:
+                    return plan
+            scale *= 1.25
+        return plan
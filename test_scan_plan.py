@@ -0,0 +1,100 @@
+# tests of the scan planning (beam orderings, pair orderings, duration estimate and deadline fitting)
+# run: python -m pytest -q test_scan_plan.py
+
+import numpy as np
+import pytest
+
+from scan_plan import (ScanPlan, StageLatency, SteerTimeModel, move_distances, order_beams, pair_order)
+
+
+def raster(theta_range, phi_range, theta_step, phi_step):
+    '''BBox5G.raster_beams without a device'''
+    if theta_range[0] < 0 or theta_range[1] > 45 or phi_range[0] < 0 or phi_range[1] > 359.9:
+        return None
+    beams = [(theta, phi) for theta in np.arange(theta_range[0], theta_range[1], theta_step)
+                          for phi in np.arange(phi_range[0], phi_range[1], phi_step)]
+    beams.insert(0, (0, 0))
+    return beams
+
+
+@pytest.mark.parametrize("order", ['grid', 'rx_major', 'hierarchical'])
+def test_pair_order_visits_every_pair_once(order):
+    pairs = pair_order(7, 5, order)
+    assert len(pairs) == 35
+    assert set(pairs) == {(tx, rx) for tx in range(7) for rx in range(5)}
+
+def test_pair_order_hierarchical_is_coarse_first():
+    pairs = pair_order(8, 8, 'hierarchical', coarse_stride=4)
+    assert pairs[:4] == [(0, 0), (0, 4), (4, 0), (4, 4)]
+
+def test_pair_order_unknown():
+    with pytest.raises(ValueError):
+        pair_order(2, 2, 'spiral')
+
+
+@pytest.mark.parametrize("order", ['raster', 'serpentine', 'nearest'])
+def test_order_beams_is_a_permutation_with_boresight_first(order):
+    beams = raster([1, 45], [0, 359.9], 5, 20)
+    ordered = order_beams(beams, order)
+    assert sorted(ordered) == sorted(beams)
+    assert ordered[0] == (0, 0)
+
+def test_order_beams_shortens_the_path():
+    beams = raster([1, 45], [0, 359.9], 5, 20)
+    raster_move = move_distances(order_beams(beams, 'raster')).sum()
+    serpentine_move = move_distances(order_beams(beams, 'serpentine')).sum()
+    nearest_move = move_distances(order_beams(beams, 'nearest')).sum()
+    assert nearest_move < serpentine_move <= raster_move
+
+def test_order_beams_unknown():
+    with pytest.raises(ValueError):
+        order_beams(raster([1, 45], [0, 359.9], 5, 20), 'spiral')
+
+
+def test_stage_latency_mean():
+    latency = StageLatency(alpha=0.5)
+    assert latency.mean('packet', 0.1) == 0.1
+    latency.observe('packet', 1.0)
+    assert latency.mean('packet') == 1.0
+    latency.observe('packet', 3.0)
+    assert latency.mean('packet') == 2.0
+    assert latency.counts['packet'] == 2
+
+def test_steer_time_prior_then_fit():
+    steer_time = SteerTimeModel(prior=0.05, min_samples=5)
+    assert steer_time.transition_time(0.3) == 0.05
+    for distance in np.linspace(0, 1, 10):
+        steer_time.observe(distance, 0.002 + 0.004 * distance)
+    assert steer_time.fit()
+    assert steer_time.transition_time(0.5) == pytest.approx(0.004)
+
+
+def test_estimate_duration_counts_steers_and_packets():
+    plan = ScanPlan(packets_per_beam=2, order='raster')
+    with pytest.raises(ValueError):
+        plan.estimate_duration()
+    beams = plan.compile(raster)
+    latency = StageLatency(); latency.observe('packet', 0.01)
+    steer_time = SteerTimeModel(prior=0.02)
+    assert plan.estimate_duration(steer_time, latency) == pytest.approx(len(beams) * (0.02 + 2 * 0.01))
+
+def test_fit_to_deadline_coarsens_to_meet_the_deadline():
+    plan = ScanPlan()
+    latency = StageLatency(); latency.observe('packet', 0.013)
+    steer_time = SteerTimeModel(prior=0.02)
+    full = len(plan.compile(raster))
+    fitted = plan.fit_to_deadline(1.0, raster, steer_time, latency)
+    assert fitted.estimate_duration(steer_time, latency) <= 1.0
+    assert len(fitted.beams) < full
+    assert plan.theta_step == 5.0 # the original plan is not changed
+
+def test_fit_to_deadline_keeps_a_plan_that_fits():
+    plan = ScanPlan()
+    fitted = plan.fit_to_deadline(1000.0, raster, SteerTimeModel(), StageLatency())
+    assert (fitted.theta_step, fitted.phi_step, fitted.packets_per_beam) == (5.0, 20.0, 2)
+
+def test_fit_to_deadline_without_steer_observations_is_not_free():
+    plan = ScanPlan()
+    latency = StageLatency(); latency.observe('packet', 0.0089) # ~3 s for all beams without steering
+    fitted = plan.fit_to_deadline(3.0, raster, SteerTimeModel(), latency)
+    assert len(fitted.beams) < len(plan.compile(raster))
@@ -8,11 +8,14 @@ import os
 from pathlib import Path
 import platform
 import sys
+import threading
 import time
 import traceback
 from abc import ABC, abstractmethod
 import numpy as np
 
+from scan_plan import SteerTimeModel, move_distances, order_beams # beam ordering and steering time
+
 logging.basicConfig(
 level=logging.DEBUG, # change to INFO for runtime logging
 format="%(asctime)s - %(name)s [%(levelname)s] %(message)s",
@@ -129,6 +132,9 @@ class TMY_Device(ABC):
         the type gives the devices capabilities and methods'''
         self.logger = logging.getLogger("Main")
         self.service = common_service.service
+        # one call at a time per device (ex. rx_track in a thread and a steer from the main thread),
+        # different devices (own serial, own connection) are steered concurrently
+        self.device_lock:threading.Lock = threading.Lock()
         self.serial_number = serial_number        
 
         info = self.service.getScanInfo(self.serial_number).RetData
@@ -231,6 +237,7 @@ class UDBox(TMY_Device):
     
 class BBox5G(TMY_Device): # BBoxOne5G with AAKit
     '''This is a subclass of TMY_Device that interfaces with the BBoxOne5G device'''
+    steer_phi_max:float = 359 # the largest phi set_beam_angle accepts
     def __init__(self,common_service:TMY_service, serial_number:str):
         '''Initializes the BB5G object with the given service
         the type gives the devices capabilities and methods'''
@@ -376,12 +383,13 @@ class BBox5G(TMY_Device): # BBoxOne5G with AAKit
         if theta < theta_min or theta > theta_max:
             self.logger.error("Theta out of range: %s" %theta)
             return False
-        phi_min,phi_max = 0, 359 # these are the limits for the BBoxOne5G
+        phi_min,phi_max = 0, self.steer_phi_max # these are the limits for the BBoxOne5G
         if phi < phi_min or phi > phi_max:
             self.logger.error("Phi out of range: %s" %phi)
             return False
         if self.setup_complete:
-            ret = self.service.setBeamAngle(self.serial_number, gain, theta, phi).RetCode is RetCode.OK
+            with self.device_lock:
+                ret = self.service.setBeamAngle(self.serial_number, gain, theta, phi).RetCode is RetCode.OK
             if ret:
                 self.logger.debug(f"{self.serial_number} Beam Angle: {gain}dB, theta:{theta}, phi:{phi}")
                 self.beam_type = BeamType.BEAM
@@ -416,21 +424,82 @@ class BBox5G(TMY_Device): # BBoxOne5G with AAKit
             self.logger.error("Phi out of range: %s" %phi)
             return False
         return True
-    
-        
+
+    def neighbourhood(self, theta:float, phi:float, theta_step:float = 2.0, phi_step:float = 10.0,
+                      radius:int = 1, diagonal:bool = False):
+        '''list the beams (theta, phi) around the given beam for a local search, the given beam first
+        the steps are taken radius times in theta and phi (plus the diagonals if diagonal is True)
+        phi wraps around 360, a negative theta is the beam on the other side of boresight (phi + 180),
+        beams beyond the theta limit or with a wrapped phi above steer_phi_max (the limit of set_beam_angle,
+        ex. 359.5) are dropped
+        at boresight (theta 0, where every phi is the same beam) the neighbourhood is the rings
+        theta_step, ..., radius * theta_step over the phi of raster_beams (0, phi_step, ...)'''
+        beams = [(theta, phi)]
+        if theta == 0:
+            for r in range(1, radius + 1):
+                t = r * theta_step
+                if t > 45.0 or not self.check_theta(t):
+                    break
+                beams.extend((t, float(p)) for p in np.arange(0, 359.9, phi_step) if p <= self.steer_phi_max)
+            return beams
+        for dt in range(-radius, radius + 1):
+            for dp in range(-radius, radius + 1):
+                if (dt == 0 and dp == 0) or (not diagonal and dt != 0 and dp != 0):
+                    continue
+                t = theta + dt * theta_step; p = phi + dp * phi_step
+                if t < 0: # through boresight
+                    t = -t; p = p + 180
+                if t > 45.0: # beyond the steering limit of the BBoxOne5G
+                    continue
+                p = round(p % 360, 6) if t > 0 else 0 # every phi is the same beam at boresight
+                if (t, p) in beams or p > self.steer_phi_max: # set_beam_angle would reject the beam
+                    continue
+                if self.check_theta(t) and self.check_phi(p):
+                    beams.append((t, p))
+        return beams
+
+
+    def raster_beams(self, theta_range:list[float] = [1.0,45.0],
+                           phi_range:list[float] = [0,359.9],
+                           theta_step:float = 1.0,
+                           phi_step:float = 1.0):
+        '''list the beams (theta, phi) of a raster, theta-major, with the boresight beam (0, 0) first
+        returns None if a range is out of bounds'''
+        if not self.check_theta(theta_range[0]) or not self.check_theta(theta_range[1]):
+            self.logger.error("Theta range out of bounds: %s" %theta_range)
+            return None
+        if not self.check_phi(phi_range[0]) or not self.check_phi(phi_range[1]):
+            self.logger.error("Phi range out of bounds: %s" %phi_range)
+            return None
+        # generate the beams for the given ranges as a list of tuples
+        beams = [(theta,phi) for theta in np.arange(theta_range[0], theta_range[1], theta_step)
+                            for phi in np.arange(phi_range[0], phi_range[1], phi_step)]
+        # add a boresight beam to the beginning of the list
+        beams.insert(0, (0,0))
+        return beams
+
     def scan_raster_generator(self, theta_range:list[float] = [1.0,45.0], 
                                     phi_range:list[float] = [0,359.9], 
                                     theta_step:float = 1.0,
                                     phi_step:float = 1.0,
-                                    gain:float|None = None):
+                                    gain:float|None = None,
+                                    beams:list[tuple[float, float]]|None = None,
+                                    order:str = 'raster',
+                                    steer_time:SteerTimeModel|None = None):
         '''setup a scan generator for the device, this will allow the device to scan the given ranges
-        yields the itteration number if successful, else None if error, setup not complete, or finished
+        yields (index, ok) for every beam, index into the beams in scan order, ok False if the beam could not
+        be set (the scan continues with the next beam), the generator is empty if the setup is not complete
+        or a range is out of bounds and ends (StopIteration) after the last beam
         the gain given or set before the scan starts, if not set or given, it will be scanned with the max gain
         \ntheta is a polar angle from down the Z (or bore) axis of the beamformer
-        \nphi is a azimuth angle on the xy-plane'''
+        \nphi is a azimuth angle on the xy-plane
+        \nbeams: scan these (theta, phi) beams instead of the raster of the ranges
+        \norder: 'raster', 'serpentine' or 'nearest' beam order (see scan_plan.order_beams)
+        \nsteer_time: record the duration of every move (from the current beam of the device) in this model
+        (the beam list in scan order is kept in self.scan_beams)'''
         if self.setup_complete is False:
             self.logger.error("Setup not complete")
-            return None
+            return
 
         # handle the beam gain
         if gain is None: # no gain is given as an argument
@@ -445,38 +514,40 @@ class BBox5G(TMY_Device): # BBoxOne5G with AAKit
                 gain = self.gain_max
 
         # handle the theta and phi ranges
-        if not self.check_theta(theta_range[0]) or not self.check_theta(theta_range[1]):
-            self.logger.error("Theta range out of bounds: %s" %theta_range)
-            return None
-        if not self.check_phi(phi_range[0]) or not self.check_phi(phi_range[1]):
-            self.logger.error("Phi range out of bounds: %s" %phi_range)
-            return None
+        if beams is None:
+            beams = self.raster_beams(theta_range, phi_range, theta_step, phi_step)
+            if beams is None:
+                return
+        beams = order_beams(beams, order)
+        self.scan_beams = beams
+        # the move to each beam, the first from the current beam (NaN, not recorded, if there is none)
+        start = [(self.theta, self.phi)] if self.theta is not None and self.phi is not None else []
+        distances = move_distances(start + list(beams))
+        if not start:
+            distances = np.concatenate([[np.nan], distances])
 
         self.logger.info("Setting up scan generator")
         self.logger.info(f"Theta Range: {theta_range}, Phi Range: {phi_range}")
         self.logger.info(f"Theta Step: {theta_step}, Phi Step: {phi_step}")
         self.beam_type = BeamType.BEAM
-        # generate the beams for the given ranges as a list of tuples
-        beams = [(theta,phi) for theta in np.arange(theta_range[0], theta_range[1], theta_step)
-                            for phi in np.arange(phi_range[0], phi_range[1], phi_step)]
-        # add a boresight beam to the beginning of the list
-        beams.insert(0, (0,0))
         len_beams = len(beams)
-        self.logger.info(f"Generated Beams: {len_beams}")
-        scan_complete = False
+        self.logger.info(f"Generated Beams: {len_beams} ({order} order, total move {np.nansum(distances):.2f})")
         # GENERATOR LOOP ---------------------------------------------------
-        while not scan_complete:
-            for ii, (theta,phi) in enumerate(beams):
-                self.logger.debug(f"Setting Beam: {ii+1} of {len_beams}")
-                if self.set_beam_angle(self.beam_gain, theta, phi): # gain, theta, phi (gain is set be)
-                    self.logger.debug(f"Beam {ii+1} set to: {self.beam}")
-                    yield ii
-                else:
-                    self.logger.error(f"Failed to set Beam {ii+1} to: {theta}, {phi}")
-                    yield None
-            scan_complete = True
-            self.logger.info("Scan generator setup complete")
-            yield None
+        for ii, (theta,phi) in enumerate(beams):
+            self.logger.debug(f"Setting Beam: {ii+1} of {len_beams}")
+            steer_start = time.perf_counter()
+            if self.set_beam_angle(self.beam_gain, theta, phi): # gain, theta, phi (gain is set be)
+                self.logger.debug(f"Beam {ii+1} set to: {self.beam}")
+                if steer_time is not None and not np.isnan(distances[ii]):
+                    steer_time.observe(distances[ii], time.perf_counter() - steer_start)
+                yield ii, True
+            else:
+                self.logger.error(f"Failed to set Beam {ii+1} to: {theta}, {phi}")
+                yield ii, False
+        if steer_time is not None and steer_time.fit():
+            self.logger.info(f"Steer time: {steer_time.intercept*1000:.2f} ms + "
+                             f"{steer_time.slope*1000:.2f} ms per unit move")
+        self.logger.info("Scan generator complete")
 
 
 # ---------------------------------------------------------- MAIN
@@ -531,9 +602,11 @@ if __name__ == "__main__":
     # test the scan raster generator
     start_time = time.time()
     logger.info("Testing the scan raster generator")
-    for ret in txbbox.scan_raster_generator([1,45], [0.0,359], 5.0, 15.0):
-        if ret is False: break
+    failed = 0
+    for ii, ok in txbbox.scan_raster_generator([1,45], [0.0,359], 5.0, 15.0):
+        failed += not ok
         time.sleep(0.01)
+    logger.info("Failed beams: %s" %failed)
     logger.info("Scan raster generator test complete")
     logger.info("Elapsed time: %s" %(time.time()-start_time))
 